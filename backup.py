@@ -0,0 +1,191 @@
+import os
+import re
+import gzip
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# dump/backups/000001-full.jsonl.gz, 000002-delta.jsonl.gz, ...
+# Every file is gzipped JSON lines:
+#   {"type": "full"|"delta", "seq": n, "base": n of the previous backup (deltas), "time": unix}
+#   {"g": globals}
+#   {"u": userid, "d": record} or {"u": userid, "x": 1} (deleted, deltas only)
+FILE_RE = re.compile(r"^(\d{6})-(full|delta)\.jsonl\.gz$")
+
+
+def list_backups(directory: str) -> list:
+  """
+  [(seq, kind, path)] oldest first
+  """
+  files = []
+  for name in os.listdir(directory):
+    match = FILE_RE.match(name)
+    if match:
+      files.append((int(match.group(1)), match.group(2), os.path.join(directory, name)))
+  return sorted(files)
+
+def read_backup(path: str):
+  """
+  Yields every line of a backup file, header first
+  """
+  with gzip.open(path, "rt", encoding="utf-8") as f:
+    for line in f:
+      yield json.loads(line)
+
+
+class Backups:
+  """
+  Chain of compressed backups: a full snapshot every full_every backups, and in between
+  deltas holding only the users changed (or deleted) since the previous backup.
+  Changes are only tracked in memory, so the first backup after a (re)start is always a full snapshot.
+  Records come from a copy-on-write snapshot, read in batches and compressed on a separate thread
+  while commands keep changing the live records.
+  """
+  def __init__(self, database, directory: str="dump/backups", full_every: int=7, keep_chains: int=2, batch: int=500):
+    self.database = database
+    self.directory = directory
+    self.full_every = full_every
+    self.keep_chains = keep_chains
+    self.batch = batch
+    self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup-io")
+    self.lock = asyncio.Lock()
+    self.chained = False # whether this process wrote a backup yet, changes from before it started were never tracked
+    os.makedirs(directory, exist_ok=True)
+
+  def files(self) -> list:
+    return list_backups(self.directory)
+
+  def _open(self, path: str):
+    return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+
+  def _write(self, f, lines: list) -> None:
+    f.write("".join(json.dumps(line, separators=(",", ":")) + "\n" for line in lines))
+
+  def _close(self, f, tmp: str, path: str) -> None:
+    f.close()
+    os.replace(tmp, path)
+
+  def _prune(self) -> None:
+    fulls = [seq for seq, kind, _ in self.files() if kind == "full"]
+    if len(fulls) <= self.keep_chains:
+      return
+    oldest = fulls[-self.keep_chains]
+    for seq, _, path in self.files():
+      if seq < oldest:
+        os.remove(path)
+
+  async def _delta(self, snapshot, userids: list):
+    for i in range(0, len(userids), self.batch):
+      yield await snapshot.get(userids[i:i+self.batch])
+
+  async def create(self, full: bool=False) -> str:
+    """
+    Writes the next backup in the chain, returns its path
+    """
+    async with self.lock:
+      database = self.database
+      files = self.files()
+      seq = files[-1][0] + 1 if files else 1
+      since_full = 0
+      for _, kind, _ in reversed(files):
+        if kind == "full":
+          break
+        since_full += 1
+      full = full or not files or not self.chained or since_full + 1 >= self.full_every
+      loop = asyncio.get_running_loop()
+      path = os.path.join(self.directory, f"{seq:06}-{'full' if full else 'delta'}.jsonl.gz")
+      tmp = path + ".tmp"
+      f = None
+      async with database.snapshot() as snapshot:
+        # Everything changed up to the snapshot goes into this backup, anything after into the next one
+        changed, deleted = database.backup_changed, database.backup_deleted
+        database.backup_changed, database.backup_deleted = set(), set()
+        try:
+          f = await loop.run_in_executor(self.executor, self._open, tmp)
+          header = {"type": "full" if full else "delta", "seq": seq, "time": int(snapshot.taken)}
+          if not full:
+            header["base"] = files[-1][0]
+          await loop.run_in_executor(self.executor, self._write, f, [header, {"g": snapshot.globals}])
+          if full:
+            batches = snapshot.scan(self.batch)
+          else:
+            batches = self._delta(snapshot, list(changed))
+          async for users in batches:
+            lines = [{"u": userid, "d": record} for userid, record in users.items()]
+            await loop.run_in_executor(self.executor, self._write, f, lines)
+          if not full and deleted:
+            await loop.run_in_executor(self.executor, self._write, f, [{"u": userid, "x": 1} for userid in deleted])
+          await loop.run_in_executor(self.executor, self._close, f, tmp, path)
+        except Exception:
+          if f is not None:
+            await loop.run_in_executor(self.executor, f.close)
+            if os.path.exists(tmp):
+              os.remove(tmp)
+          database.backup_changed |= changed - database.backup_deleted
+          database.backup_deleted |= deleted - database.backup_changed
+          raise
+      self.chained = True
+      await loop.run_in_executor(self.executor, self._prune)
+      return path
+
+
+def chain(directory: str, upto: int=None) -> list:
+  """
+  Paths needed to rebuild the database as of backup upto (the latest by default): the last full snapshot and the deltas after it
+  """
+  files = [f for f in list_backups(directory) if upto is None or f[0] <= upto]
+  for i in range(len(files) - 1, -1, -1):
+    if files[i][1] == "full":
+      files = files[i:]
+      break
+  else:
+    raise RuntimeError("No full snapshot found")
+  for prev, (seq, _, path) in zip(files, files[1:]):
+    base = next(read_backup(path)).get("base")
+    if base != prev[0]:
+      raise RuntimeError(f"Backup {seq} is based on {base}, not {prev[0]}, the chain is broken")
+  return [path for _, _, path in files]
+
+
+def restore(storage, paths: list, batch: int=1000) -> int:
+  """
+  Replays a backup chain into storage, returns the number of users restored.
+  Users that are in storage but not in the backup are removed.
+  """
+  others, written, ops = None, set(), []
+  for path in paths:
+    lines = read_backup(path)
+    header = next(lines)
+    for line in lines:
+      if "g" in line:
+        others = line["g"]
+      elif line.get("x"):
+        ops.append(("delete", line["u"]))
+        written.discard(line["u"])
+      else:
+        ops.append(("replace", line["u"], line["d"]))
+        written.add(line["u"])
+      if len(ops) >= batch:
+        storage.write(ops)
+        ops = []
+    print(f"Applied {header['type']} backup {header['seq']} from {time.ctime(header['time'])}")
+  ops += [("delete", userid) for userid in storage.user_ids() - written]
+  for i in range(0, len(ops), batch):
+    storage.write(ops[i:i+batch])
+  if others is not None:
+    storage.put_globals(others)
+  return len(written)
+
+
+if __name__ == "__main__":
+  from storage import create_storage
+  parser = argparse.ArgumentParser(description="Rebuild the database from a backup chain")
+  parser.add_argument("--dir", default="dump/backups")
+  parser.add_argument("--upto", type=int, default=None, help="restore as of this backup number (latest by default)")
+  parser.add_argument("--backend", default=None, help="mongo, sqlite or memory (defaults to DB_BACKEND)")
+  args = parser.parse_args()
+  paths = chain(args.dir, args.upto)
+  users = restore(create_storage(args.backend), paths)
+  print(f"Restored {users} users from {len(paths)} backup files")
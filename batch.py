@@ -0,0 +1,63 @@
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def _ready() -> bool:
+  return True
+
+
+class BatchPool:
+  """
+  Runs the number crunching of whole economy jobs in worker processes. The event loop only extracts the columns
+  a job needs from the records and writes the result back, so more cores take the rest off the gateway thread.
+  Jobs are module level functions of plain values (lists, dicts, numbers, strings): they and their result are pickled.
+  """
+  def __init__(self, workers: int=2, min_rows: int=1000):
+    self.workers = workers # 0 runs every job inline
+    self.min_rows = min_rows # smaller jobs run inline, pickling them would cost more than it saves
+    self.pool = None
+    self.stats = {"offloaded": 0, "inline": 0, "rows": 0, "last_job": 0.0, "max_job": 0.0}
+
+  def start(self) -> None:
+    """
+    Forks the workers. Must run before any other thread is started (MongoClient's monitors, the database's, discord's):
+    a fork only copies the thread calling it, and the workers are never forked again afterwards
+    """
+    if self.workers <= 0 or self.pool is not None:
+      return
+    try:
+      self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+      self.pool.submit(_ready).result() # forks every worker now
+    except (ValueError, OSError) as e:
+      print(f"Could not start the batch pool, batch jobs will run inline: {e}")
+      self.pool = None
+
+  async def run(self, func, rows: int, *args):
+    """
+    Returns func(*args), computed in a worker if the job has at least min_rows rows
+    """
+    start = time.perf_counter()
+    if self.pool is not None and rows >= self.min_rows:
+      try:
+        result = await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+        self.stats["offloaded"] += 1
+      except BrokenProcessPool:
+        print("A batch worker died, batch jobs will run inline")
+        self.pool = None
+        return await self.run(func, rows, *args)
+    else:
+      result = func(*args)
+      self.stats["inline"] += 1
+    took = time.perf_counter() - start
+    self.stats["rows"] += rows
+    self.stats["last_job"] = took
+    self.stats["max_job"] = max(self.stats["max_job"], took)
+    return result
+
+  def close(self) -> None:
+    if self.pool is not None:
+      self.pool.shutdown(wait=False, cancel_futures=True)
+      self.pool = None
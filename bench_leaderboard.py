@@ -0,0 +1,57 @@
+import time
+import random
+import argparse
+from leaderboard import RankIndex
+
+# python bench_leaderboard.py [--users 10000 100000] [--calls 100] [--seed 1]
+# Per call cost of a top 10 leaderboard plus the caller's rank: "as was" builds a dict of every user's value and sorts it
+# on every call (like the leaderboard command used to), "index" reads a RankIndex that is kept up to date as balances change.
+
+
+def synthetic_values(n: int, rng: random.Random) -> dict:
+  return {str(10**17 + i): rng.randint(0, 10**9) for i in range(n)}
+
+def as_was(values: dict, userid: str) -> tuple:
+  lb = {u: v for u, v in values.items()}
+  ordered = list(reversed(sorted(lb.items(), key=lambda x: x[1])))
+  rank = next(i for i, (u, _) in enumerate(ordered) if u == userid) + 1
+  return ordered[:10], rank
+
+def indexed(index: RankIndex, userid: str) -> tuple:
+  return index.top(10), index.rank(userid)
+
+def per_call(func, args: list) -> float:
+  start = time.perf_counter()
+  for a in args:
+    func(*a)
+  return (time.perf_counter() - start) / len(args)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark leaderboard reads against a maintained rank index")
+  parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+  parser.add_argument("--calls", type=int, default=100)
+  parser.add_argument("--seed", type=int, default=1)
+  args = parser.parse_args()
+  columns = ("as was", "index", "update", "build")
+  print(f"{'users':>10} " + " ".join(f"{k:>10}" for k in columns) + "   (per call, build is once)")
+  for n in args.users:
+    rng = random.Random(args.seed)
+    values = synthetic_values(n, rng)
+    userids = list(values)
+    start = time.perf_counter()
+    index = RankIndex("balance", values)
+    times = {"build": time.perf_counter() - start}
+    callers = [(rng.choice(userids),) for _ in range(args.calls)]
+    times["as was"] = per_call(lambda u: as_was(values, u), callers[:max(args.calls // 10, 1)])
+    times["index"] = per_call(lambda u: indexed(index, u), callers)
+    changes = [(rng.choice(userids), rng.randint(0, 10**9)) for _ in range(args.calls * 10)]
+    def update(userid, value):
+      values[userid] = value
+      index.set(userid, value)
+    times["update"] = per_call(update, changes)
+    for (userid,) in callers[:10]:
+      (expected, expected_rank), (top, rank) = as_was(values, userid), indexed(index, userid)
+      if [v for _, v in expected] != [v for _, v in top] or expected_rank != rank:
+        raise AssertionError("the index does not match a full sort")
+    print(f"{n:>10} " + " ".join(f"{times[k]*1000:>8.3f}ms" for k in columns))
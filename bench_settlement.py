@@ -0,0 +1,119 @@
+import time
+import random
+import argparse
+import settlement
+
+# python bench_settlement.py [--users 10000 100000 1000000] [--hours 1] [--seed 1]
+# Times one hour (or --hours) of settlement over synthetic users, with numpy and with the plain Python fallback.
+# "legacy" is the old per user loop without its stray pass over every user, "as was" keeps that pass (O(N²)) and only runs up to --quadratic users.
+# A catch up over several hours is checked against settling the same users one hour at a time.
+
+
+def synthetic_users(n: int, rng: random.Random) -> list:
+  users = []
+  for i in range(n):
+    boosts = {"income": [], "xp": []}
+    if rng.random() < 0.1:
+      boosts["income"].append({str(rng.choice([0.5, 1, 2])): rng.randint(1, 24)})
+    if rng.random() < 0.05:
+      boosts["xp"].append({str(rng.choice([0.5, 1])): rng.randint(1, 24)})
+    users.append((str(i), {
+      "balance": rng.randint(0, 10**6),
+      "income": rng.randint(0, 5000),
+      "income_boost": rng.choice([0, 0, 0.5, 1]),
+      "cleanliness": rng.choice([100, 100, 75.5, 20, 0]),
+      "boosts": boosts
+    }))
+  return users
+
+def copy_users(users: list) -> list:
+  return [(userid, {**record, "boosts": {k: [dict(b) for b in v] for k, v in record["boosts"].items()}}) for userid, record in users]
+
+def with_expiry(users: list) -> list:
+  """
+  The users with their boosts as they are stored now, expiring at an income tick counted from tick 0
+  """
+  users = copy_users(users)
+  for _, record in users:
+    for type_, boosts in record["boosts"].items():
+      record["boosts"][type_] = [{k: v*settlement.HOUR} for boost in boosts for k, v in boost.items()]
+    record["boost_mult"] = {type_: settlement.personal_mult(boosts) for type_, boosts in record["boosts"].items()}
+  return users
+
+def balances(users: list) -> list:
+  return [(record["balance"], record["cleanliness"]) for _, record in users]
+
+def legacy(users: list, global_boost: float, quadratic: bool=False) -> None:
+  """
+  The hourly loop as it was (with its extra pass over every user if quadratic), counting boosts down without skipping any
+  """
+  for _, record in users:
+    personal_mult = 0
+    for _ in (users if quadratic else (None,)):
+      for boost in record["boosts"]["income"]:
+        for k in boost:
+          personal_mult += float(k)
+    total_boosts = record["income_boost"] + global_boost + personal_mult
+    if total_boosts == 0:
+      total_boosts = 1
+    record["balance"] += round(record["income"]*total_boosts/100*record["cleanliness"])
+    record["cleanliness"] -= 0.5
+    if record["cleanliness"] < 0:
+      record["cleanliness"] = 0
+    for type_ in ("income", "xp"):
+      record["boosts"][type_] = [{k: v - 1} for boost in record["boosts"][type_] for k, v in boost.items() if v > 1]
+
+def hourly(users: list, hours: int, batch: int) -> None:
+  """
+  settle() run once per hour, the way users were paid before they could fall behind
+  """
+  for hour in range(hours):
+    for i in range(0, len(users), batch):
+      settlement.settle(users[i:i+batch], [(1, 0, 1)], 1, hour*settlement.HOUR)
+
+def close(actual: list, expected: list) -> bool:
+  """
+  Balances at most a coin apart (a catch up rounds once, the hourly loop carries what each hour rounded off)
+  """
+  return all(abs(a[0] - e[0]) <= 1 and abs(a[1] - e[1]) < 1e-9 for a, e in zip(actual, expected))
+
+def timed(func, *args, hours: int=1) -> float:
+  start = time.perf_counter()
+  for _ in range(hours):
+    func(*args)
+  return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark the hourly income settlement")
+  parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--quadratic", type=int, default=10_000, help="largest user count to time the O(N²) loop at")
+  parser.add_argument("--hours", type=int, default=1, help="hours to catch up on, the old loops run once per hour")
+  parser.add_argument("--batch", type=int, default=500, help="users per settle() call, like Database.scan_batches")
+  args = parser.parse_args()
+  numpy = settlement.np
+  columns = ("as was", "legacy", "python", "numpy")
+  print(f"{'users':>10} " + " ".join(f"{k:>10}" for k in columns))
+  for n in args.users:
+    users = synthetic_users(n, random.Random(args.seed))
+    run = lambda users: [settlement.settle(users[i:i+args.batch], [(1, 0, args.hours)], args.hours) for i in range(0, len(users), args.batch)]
+    times = {"as was": timed(legacy, copy_users(users), 1, True, hours=args.hours) if n <= args.quadratic else float("nan")}
+    expected = copy_users(users)
+    times["legacy"] = timed(legacy, expected, 1, hours=args.hours)
+    settlement.np = None
+    fallback = with_expiry(users)
+    times["python"] = timed(run, fallback)
+    settlement.np = numpy
+    vectorized = with_expiry(users)
+    times["numpy"] = timed(run, vectorized) if numpy is not None else float("nan")
+    if numpy is not None and fallback != vectorized:
+      raise AssertionError("numpy and the Python fallback disagree")
+    if args.hours == 1 and balances(fallback) != balances(expected):
+      raise AssertionError("settle() does not match the old loop") # more hours are rounded once instead of every hour
+    if args.hours > 1:
+      stepped = with_expiry(users)
+      hourly(stepped, args.hours, args.batch)
+      if not close(balances(fallback), balances(stepped)):
+        raise AssertionError("catching up does not match settling every hour")
+    print(f"{n:>10} " + " ".join(f"{times[k]:>9.3f}s" if times[k] == times[k] else f"{'-':>10}" for k in columns))
@@ -36,6 +36,7 @@ class TopGG(commands.Cog):
     except Exception as err:
       print(f"Failed to get vote info: {err}")
     
+    await self.bot.database.prefetch([data["user"]])
     if str(user.id) in self.bot.db["economy"]:
       if self.bot.db["economy"][str(user.id)]["vote"]["last_vote"] + 3600*24*3 >= int(time.time()):
         self.bot.db["economy"][str(user.id)]["vote"]["streak"] += 1
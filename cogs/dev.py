@@ -9,6 +9,10 @@ from errors import *
 from discord import Object, app_commands
 from discord.ext import commands
 from importlib import reload
+from storage import default_globals
+from records import memory_report
+from migrations import SCHEMA_VERSION
+from settlement import flatten_boosts, shift_boosts
 from typing import Optional, Literal
 import importlib
 
@@ -226,96 +230,123 @@ class Dev(commands.Cog, command_attrs=dict(hidden=True)):
       await self.bot.close()
     elif arg1 == "restart":
       await ctx.send("Restarting bot... `This might take a few seconds`")
+      await self.bot.database.journal.sync()
+      await self.bot.save_db(force=True)
       os.execv(sys.executable, ['python'] + sys.argv)
     elif arg1 == "task":
-      events = self.bot.get_cog("events")
-      try:
-        await events.tasksloop()
-        await ctx.send("Task has started")
-      except:
-        await ctx.send("Task already running")
+      if arg2 in self.bot.scheduler.jobs:
+        await self.bot.scheduler.run_job(arg2)
+        await ctx.send(f"Ran `{arg2}`")
+      else:
+        self.bot.scheduler.start()
+        await ctx.send("Scheduler is running")
+    elif arg1 == "schedule":
+      scheduler = self.bot.scheduler
+      lines = []
+      for name in scheduler.jobs:
+        deadline, stats = scheduler.deadline(name), scheduler.stats[name]
+        lines.append(f"""**{name}**: next {f'<t:{int(deadline)}:R>' if deadline is not None else '`not scheduled`'} | runs: `{stats['runs']}` (failed: `{stats['failures']}`)
+Last run: <t:{stats['last_run']}:R>, took `{round(stats['last_duration']*1000, 2)}ms`, `{round(stats['last_lag'], 2)}s` late | Slowest: `{round(stats['max_duration']*1000, 2)}ms` | Latest: `{round(stats['max_lag'], 2)}s`""")
+      embed = discord.Embed(
+        title = "Scheduled Jobs",
+        description = "\n".join(lines) or "No jobs",
+        color = blurple
+      )
+      await ctx.send(embed=embed)
+    elif arg1 == "telemetry":
+      telemetry = self.bot.telemetry
+      summary = telemetry.summary()
+      by = arg2 if arg2 in ("requests", "rate_limited", "errors", "max_latency") else "requests"
+      routes = "\n".join(
+        f"`{route}`: `{stats['requests']}` reqs, avg `{round(stats['total_latency']/stats['requests']*1000)}ms`, max `{round(stats['max_latency']*1000)}ms`, 429s: `{stats['rate_limited']}`, errors: `{stats['errors']}`"
+        for route, stats in telemetry.top_routes(10, by)
+      )
+      buckets = " | ".join(f"{bucket}: `{count}`" for bucket, count in telemetry.retry_after.items()) or "none"
+      latest = "\n".join(f"<t:{at}:R> `{route}` retry after `{retry_after}s` ({scope})" for at, route, retry_after, scope in list(telemetry.rate_limits)[-5:]) or "none"
+      heartbeat = " / ".join(f"`{round(summary[k]*1000, 1)}ms`" if summary[k] is not None else "`-`" for k in ("heartbeat_last", "heartbeat_avg", "heartbeat_max"))
+      embed = discord.Embed(
+        title = "Discord Telemetry",
+        description = f"""
+Since <t:{summary['since']}:R>: `{summary['requests']}` requests, `{summary['rate_limited']}` rate limited, `{summary['errors']}` errors
+Heartbeat (last / avg / max): {heartbeat}
+429s by retry_after: {buckets}
+Latest 429s:
+{latest}
+
+Routes by {by}:
+{routes or "none"}
+""",
+        color = blurple
+      )
+      await ctx.send(embed=embed)
     elif arg1 == "resetdbo":
       await ctx.send("Resetting dbo...")
       try:
         total_cmds_ran = self.bot.dbo["others"]["total_commands_ran"]
       except Exception:
         total_cmds_ran = -1
-      self.bot.dbo = {
-        "others":
-        {
-          "alert_msg": "Hello there! \nUse `/help` for help!!",
-          "read_alert": [], # list of user IDs
-          "alert_ping": False,
-          "lottery": {
-            "cost": 1,
-            "msgid": None,
-            "end": 1,
-          },
-          "total_commands_ran": 1057,
-          "global_income_boost": {}, # {mult: duration (h)} 
-          "global_xp_boost": 0, # XP BOOST NOT IMPLEMENTED
-          "maintenancemode": False,
-          "shop_items": {},
-          "last_shop_reset": 1669564800,
-          "user_blacklist": {},
-          "server_blacklists": {},
-          "last_income": int(time.time()) - (int(time.time()%3600)), # makes it the nearest hour
-          "error_count": 1,
-          "code": {}
-        }
-      }
+      self.bot.dbo["others"] = default_globals()
       await ctx.send("DBO reset! \nTotal commands ran: " + str(total_cmds_ran))
-    elif arg1 == "updatequest":
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user]["quest"] = {
-          "fish" : {
-            "name": "tuna",
-            "times": 5,
-            "completed": False
-          },
-          "hunt" : {
-            "times": 1,
-            "times_completed": 0,
-            "completed": False
-          },
-          "income" : {
-            "times": 1,
-            "times_completed": 0,
-            "completed": False
-          }
-        }
-        self.bot.db["economy"][user]["last_quest"] = 1
-      await ctx.reply("updated database!")
+    elif arg1 == "dbstats":
+      stats = self.bot.database.stats
+      accrual = self.bot.accrual.stats
+      embed = discord.Embed(
+        title = "Database Stats",
+        description = f"""
+Queue depth: `{self.bot.database.queue_depth}`
+Flushes: `{stats['flushes']}` | Writes: `{stats['writes']}` (field updates: `{stats['field_updates']}`, whole records: `{stats['replaces']}`)
+Bytes written: `{stats['bytes_written']:,}`
+Last flush: <t:{stats['last_flush']}:R> (`{round(stats['last_flush_duration']*1000, 2)}ms`)
+Slowest flush: `{round(stats['max_flush_duration']*1000, 2)}ms`
+Failed flushes in a row: `{stats['failed_flushes']}`
+Cached users: `{len(self.bot.db['economy'].cache)}` / `{self.bot.db['economy'].max_size}` (hits: `{stats['cache_hits']}`, prefetched: `{stats['prefetched']}`, blocking fetches: `{stats['blocking_fetches']}`)
+Journal: `{self.bot.database.journal.stats['entries']}` entries, `{self.bot.database.journal.stats['bytes_written']:,}` bytes, `{len(self.bot.database.journal.segments())}` segments on disk
+Flush interval: `{self.bot.flusher.seconds}s` | Threshold: `{db_flush_threshold}`
+Settled: `{accrual['settled']}` users, `{accrual['hours']}` hours (unsettleable: `{accrual['unsettleable']}`) | Slowest settlement slice: `{round(accrual['max_slice']*1000, 2)}ms`
+Last sweep: <t:{accrual['last_sweep']}:R> (`{round(accrual['last_sweep_duration'], 2)}s`, `{accrual['sweep_slices']}` slices of up to `{round(accrual['sweep_max_slice']*1000, 2)}ms`, longest loop stall `{round(accrual['sweep_max_stall']*1000, 2)}ms`)
+Longest loop stall: `{round(self.bot.loop_monitor.stats['max_stall']*1000, 2)}ms`
+Batch jobs: `{self.bot.batch_pool.stats['offloaded']}` in workers, `{self.bot.batch_pool.stats['inline']}` inline (`{self.bot.batch_pool.stats['rows']:,}` rows, slowest `{round(self.bot.batch_pool.stats['max_job']*1000, 2)}ms`)
+""",
+        color = blurple
+      )
+      await ctx.send(embed=embed)
+    elif arg1 == "flushinterval":
+      if arg2 is not None and arg2.isdigit():
+        self.bot.flusher.change_interval(seconds=int(arg2))
+        await ctx.send(f"Flush interval set to **{arg2}s**")
+      else:
+        await ctx.send("arg2 is not a number!")
+    elif arg1 == "memreport":
+      report = memory_report(list(self.bot.db["economy"].cache.values()))
+      saved = 100 - report["after"] * 100 // report["before"] if report["before"] else 0
+      await ctx.send(f"Memory per user ({report['users']} cached): `{report['before']:,}` bytes before, `{report['after']:,}` bytes now (**{saved}%** smaller)")
     elif arg1 == "viewdbo":
       print(self.bot.dbo["others"])
       await ctx.send("dbo in console!")
     elif arg1 == "updatedbo":
       self.bot.dbo["others"].pop("bugs")
       await ctx.send("dbo updated!")
-    elif arg1 == "updatechests":
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user].pop("chests")
-        self.bot.db["economy"][user]["diamonds"] = 0
-    elif arg1 == "updatefish":
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user]["fish"] = {"last_fish" : 0, "rod_level" : 1, "tuna" : 0, "grouper" : 0, "snapper" : 0, "salmon" : 0, "cod" : 0}
-      await ctx.send("updated fish db")
-    elif arg1 == "updatepets":
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user]["pets"]["food"] = 0
-      await ctx.send("updated pets db")
-    elif arg1 == "updategames":
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user]["games"] = {"sliding_puzzle_8_moves": -1, "sliding_puzzle_8_time": -1}
-      await ctx.send("updated games db")
-    elif arg1 == "updateusers":
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user]["vote"] = {
-          "last_vote": 1,
-          "count": 0,
-          "streak": 0
-        }
-      await ctx.send("updated users db (income)")
+    elif arg1 == "migrate":
+      # dev migrate [dry|status]: brings every record up to the latest schema in batches
+      migrator = self.bot.migrator
+      if arg2 == "status":
+        p = migrator.progress
+        pending = len(await migrator.pending())
+        await ctx.send(f"Schema version: `{SCHEMA_VERSION}` | Outdated users: `{pending}` \nLast run: `{p['done']}/{p['total']}` checked, `{p['migrated']}` migrated, `{p['failed']}` failed{' (dry run)' if p['dry_run'] else ''}{' - running' if migrator.running else ''}")
+        return
+      if migrator.running:
+        await ctx.send("A migration is already running!")
+        return
+      dry_run = arg2 == "dry"
+      msg = await ctx.send(f"Migrating users to schema `{SCHEMA_VERSION}`{' (dry run)' if dry_run else ''}...")
+      last_edit = 0
+      async def on_progress(p):
+        nonlocal last_edit
+        if time.time() - last_edit >= 5:
+          last_edit = time.time()
+          await msg.edit(content=f"Migrating users to schema `{SCHEMA_VERSION}`{' (dry run)' if dry_run else ''}: `{p['done']}/{p['total']}` ({p['migrated']} migrated, {p['failed']} failed)")
+      p = await migrator.run(dry_run, on_progress)
+      await msg.edit(content=f"Migration {'dry run ' if dry_run else ''}done: `{p['total']}` outdated users, `{p['migrated']}` {'would be ' if dry_run else ''}migrated, `{p['failed']}` failed")
     elif arg1 == "resetdaily":
       if arg2 is None:
         self.bot.db["economy"][str(ctx.author.id)]["last_daily"] = int(time.time()) - 3600*24
@@ -331,25 +362,24 @@ class Dev(commands.Cog, command_attrs=dict(hidden=True)):
       self.bot.db["economy"][str(ctx.author.id)]["golden_ticket"] += 100
       await ctx.send("Location requirements given")
     elif arg1 == "rm1boost":
-      boosts = self.bot.db["economy"][str(ctx.author.id)]["boosts"]
-      type_ = "income"
-      for user in self.bot.db["economy"]:
-        for boost in range(len(boosts[type_])): # boost = {mult: duration}
-          for k in boosts[type_][boost]:
-            self.bot.db["economy"][user]["boosts"][type_][boost][k] -= 1
-    
-            if self.bot.db["economy"][user]["boosts"][type_][boost][k] <= 0:
-              self.bot.db["economy"][user]["boosts"][type_].pop(boost)
+      tick = self.bot.dbo["others"]["last_income"]
+      async for users in self.bot.database.scan_batches(5000):
+        records = [record for _, record in users if record["boosts"]["income"]]
+        lists = [record["boosts"]["income"] for record in records]
+        sizes = [len(boosts) for boosts in lists]
+        boosts = flatten_boosts(lists)
+        shifted = await self.bot.batch_pool.run(shift_boosts, len(boosts[0]), boosts, -3600, tick)
+        for i, (kept, mult) in shifted.items():
+          if records[i]["boosts"]["income"] is lists[i] and len(lists[i]) == sizes[i]: # not settled or bought into while the workers had it
+            records[i]["boosts"]["income"] = kept
+            records[i]["boost_mult"]["income"] = mult
       await ctx.send("1h of income boost removed from everyone")
-    elif arg1 == "rmglobal":
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user]["boosts"].pop("global")
-      await ctx.send("Global income boost removed (from user db)")
     elif arg1 == "addglobalboost":
-      self.bot.dbo["others"]["global_income_boost"] = {"2": 24*7}
+      self.bot.accrual.add_global_boost("2", 24*7)
       await ctx.send("Global boost added (2x, 7d)")
     elif arg1 == "getdata":
       if arg2 is not None and arg2.isdigit():
+        await self.bot.database.prefetch([arg2])
         userdata = self.bot.db["economy"][arg2]
         with open("dump/userdata.txt", "w") as data:
           data.truncate(0)
@@ -358,11 +388,6 @@ class Dev(commands.Cog, command_attrs=dict(hidden=True)):
         os.remove("dump/userdata.txt")
       else:
         await ctx.send("arg2 is not a number!")
-    elif arg1 == "updaterecipes":
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user]["recipes"] = {
-          "fragments": {"normal": 20, "dark": 0, "milk": 0, "almond": 0, "white": 0, "caramel": 0, "peanut butter": 0, "strawberry": 0}
-        }
 
   @app_commands.command(name="givereward")
   @is_owner()
@@ -393,9 +418,9 @@ class Dev(commands.Cog, command_attrs=dict(hidden=True)):
 
   @commands.command()
   @commands.is_owner()
-  async def backup(self, ctx):
+  async def backup(self, ctx, kind: str=None):
     await ctx.message.delete()
-    await self.bot.create_backup()
+    await self.bot.create_backup(full=kind == "full")
 
   @commands.command()
   @commands.is_owner()
@@ -545,8 +570,10 @@ class Dev(commands.Cog, command_attrs=dict(hidden=True)):
     self.bot.dbo["others"]["lottery"] = {
       "msgid": lottery_msg.id,
       "end": ends,
-      "cost": price
+      "cost": price,
+      "entrants": []
     }
+    self.bot.scheduler.reschedule("lottery", ends)
 
     
     
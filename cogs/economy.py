@@ -6,6 +6,8 @@ import asyncio
 from vars import *
 from utils import *
 from errors import *
+from migrations import SCHEMA_VERSION
+from settlement import add_boost
 from discord import app_commands
 from typing import Literal, Optional
 from datetime import timedelta
@@ -31,11 +33,55 @@ async def buy_item(itx, item: str):
     mag = info[1]
 
     if mag == "personal":
-      itx.client.db["economy"][str(itx.user.id)]["boosts"][type_.lower()].append(
-        {mult: duration}
-      )
+      add_boost(itx.client.db["economy"][str(itx.user.id)], type_.lower(), mult, duration, itx.client.dbo["others"]["last_income"])
     elif mag == "global":
-      itx.client.dbo["others"]["global_income_boost"] = {mult: duration}
+      itx.client.accrual.add_global_boost(mult, duration)
+
+class LeaderboardButtons(discord.ui.View):
+  def __init__(self, cog, userID, type_: str, pages: int, scopable: bool):
+    self.cog = cog
+    self.userID = userID
+    self.type_ = type_
+    self.page = 0
+    self.pages = pages
+    self.server = False # showing this server's leaderboard
+    super().__init__(timeout=120)
+    if not scopable:
+      self.remove_item(self.toggle_scope)
+    self.update_buttons()
+
+  def update_buttons(self):
+    self.previous_page.disabled = self.page <= 0
+    self.next_page.disabled = self.page >= self.pages - 1
+    self.toggle_scope.label = "Global" if self.server else "This Server"
+
+  async def show(self, itx: discord.Interaction):
+    embed, self.pages = await self.cog.leaderboard_page(itx, self.type_, self.page, self.server)
+    self.page = min(self.page, self.pages - 1)
+    self.update_buttons()
+    await itx.response.edit_message(embed=embed, view=self)
+
+  @discord.ui.button(label = "Previous", emoji = "⬅️", style = discord.ButtonStyle.blurple)
+  async def previous_page(self, itx: discord.Interaction, button: discord.ui.Button):
+    self.page -= 1
+    await self.show(itx)
+
+  @discord.ui.button(label = "Next", emoji = "➡️", style = discord.ButtonStyle.blurple)
+  async def next_page(self, itx: discord.Interaction, button: discord.ui.Button):
+    self.page += 1
+    await self.show(itx)
+
+  @discord.ui.button(label = "This Server", emoji = "🏠", style = discord.ButtonStyle.secondary)
+  async def toggle_scope(self, itx: discord.Interaction, button: discord.ui.Button):
+    self.server = not self.server
+    self.page = 0
+    await self.show(itx)
+
+  async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
+    if self.userID == itx.user.id:
+      return True
+    return await itx.client.itx_check(itx)
 
 class LocationButtons(discord.ui.View):
   def __init__(self, userID, next_location=None, disabled=True):
@@ -56,6 +102,7 @@ class LocationButtons(discord.ui.View):
     await itx.response.edit_message(view=self)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -88,6 +135,7 @@ class ChestButtons(discord.ui.View):
     await itx.response.send_message(embed = embed)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -198,6 +246,7 @@ Legendary Chest: **200{diamond}**
     
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -212,40 +261,23 @@ class Economy(commands.Cog, name = "General Commands"):
     """Start your chocolate journey here!"""
     if str(itx.user.id) not in self.bot.db["economy"]:
       self.bot.db["economy"][str(itx.user.id)] = {
+        "schema": SCHEMA_VERSION,
         "balance": 500, "last_work": 1, "last_quest": int(time.time()), "last_clean": 1,
         "last_daily": 1, "last_weekly": 1, "last_monthly": 1, "daily_streak": 0, 
-        "last_cf": 1, "cleanliness": 100,
+        "last_cf": 1, "cleanliness": 100, "settled": self.bot.dbo["others"]["last_income"],
         "golden_ticket": 0, "claimed_ticket": False, "account_age": int(time.time()),
-        "bought_from_shop": [],
+        "bought_from_shop": {"reset": 0, "items": []}, # items bought since the "reset" shop reset
         "sponsor": 0, "diamonds": 0, "income_boost": 0, "income": 100, "bugs_found": 0,
         "unlocked_upgrades": ["farm"],
         "vote": {"last_vote": 1, "count": 0, "streak": 0},
         "counting": {"work": 0, "hunt": 0, "fish": 0},
         "levels": {"xp" : 0, "xp_mult" : 1, "level" : 1, "xp_needed" : 20}, 
-        "boosts": {"income": [], "xp": []}, # "income": [{mult: duration (s)}]
+        "boosts": {"income": [], "xp": []}, "boost_mult": {"income": 0, "xp": 0}, # "income": [{mult: expiry tick}]
         "upgrades": {
-          "farm": {
-            "farmer": {"name": f"Farmer", "max": 10, "level": 1},
-            "store": {"name": f"Store", "max": 8, "level": 1}, 
-            "van": {"name": f"Delivery Van", "max": 6, "level": 0},
-            "storage_tank": {"name": f"Storage Tank", "max": 8, "level": 1},
-            "warehouse": {"name": f"Warehouse", "max": 12, "level": 1},
-           },
-          "factory": {
-            "bean_grinder": {"name": f"Bean Grinder", "max": 10, "level": 1},
-            "chocolate_moulder": {"name": f"Chocolate Moulder", "max": 8, "level": 1},
-            "chocolate_freezer": {"name": f"Chocolate Freezer", "max": 5, "level": 1},
-            "workers": {"name": f"Worker", "max": 12, "level": 1},
-            "chocolate_packager": {"name": f"Chocolate Packager", "max": 5, "level": 1},
-          },
-          "distribution_center": {
-            "fork_lifts": {"name": f"Fork Lifts", "max": 15, "level": 1},
-            "packaging_machine": {"name": f"Packaging Machine", "max": 15, "level": 1},
-            "storage_shelves": {"name": f"Storage Shelves", "max": 12, "level": 1},
-            "trucks": {"name": f"Trucks", "max": 8, "level": 1},
-            "managers": {"name": f"Managers", "max": 10, "level": 1},
-          }
-        }, 
+          "farm": {"farmer": {"level": 1}, "store": {"level": 1}, "van": {"level": 0}, "storage_tank": {"level": 1}, "warehouse": {"level": 1}},
+          "factory": {"bean_grinder": {"level": 1}, "chocolate_moulder": {"level": 1}, "chocolate_freezer": {"level": 1}, "workers": {"level": 1}, "chocolate_packager": {"level": 1}},
+          "distribution_center": {"fork_lifts": {"level": 1}, "packaging_machine": {"level": 1}, "storage_shelves": {"level": 1}, "trucks": {"level": 1}, "managers": {"level": 1}}
+        }, # names and max levels live in upgrade_catalog
         "recipes": {
           "fragments": {"normal": 20, "dark": 0, "milk": 0, "almond": 0, "white": 0, "caramel": 0, "peanut butter": 0, "strawberry": 0}
         },
@@ -512,7 +544,7 @@ Benefits:
     Check out your shop offers!
     """
     items = self.bot.dbo["others"]["shop_items"]
-    bought = self.bot.db["economy"][str(itx.user.id)]["bought_from_shop"]
+    bought = bought_from_shop(self.bot.db["economy"][str(itx.user.id)], self.bot.dbo["others"])
     msg = "Welcome to the shop! \nWe offer new items everyday so come back tomorrow for even more deals! \n"
 
     for item in items:
@@ -538,7 +570,7 @@ Cost: **{items[item]} {ticket}**
     """
     color = red
     if item in self.bot.dbo["others"]["shop_items"]:
-      if item in self.bot.db["economy"][str(itx.user.id)]["bought_from_shop"]:
+      if item in bought_from_shop(self.bot.db["economy"][str(itx.user.id)], self.bot.dbo["others"]):
         msg = f"You have already bought this item from the shop! \nUse `{prefix}shop` to check out your shop offers again."
       else:
         cost = self.bot.dbo["others"]["shop_items"][item]
@@ -549,7 +581,7 @@ Cost: **{items[item]} {ticket}**
             msg = "There is already a global income boost active! Wait until the boost finishes before buying another global boost!"
           else:
             self.bot.db["economy"][str(itx.user.id)]["golden_ticket"] -= cost
-            self.bot.db["economy"][str(itx.user.id)]["bought_from_shop"].append(item)
+            add_shop_purchase(self.bot.db["economy"][str(itx.user.id)], self.bot.dbo["others"], item)
             await buy_item(itx, item)
             msg = f"You have bought **{item}** from the shop! \nUse `{prefix}shop` to check out your shop offers again."
             color = green
@@ -673,58 +705,76 @@ Cost: **{items[item]} {ticket}**
     await get_quests(itx)
 
   # Leaderboards
-  @factory_check()
-  @app_commands.command(name = "leaderboard")
-  async def leaderboard(self, itx: discord.Interaction, type: Optional[Literal["balance", "levels", "tickets", "sponsors"]]="balance"):
-    """View the various leaderboards here!"""
-    note = ""
-    lb_dump = {}
-    for user in self.bot.db["economy"]:
-      if type == "balance":
-        lb_dump[user] = self.bot.db["economy"][user]["balance"]
-        emoji = coin
-        note = f"There are currently `{len(self.bot.db['economy'])}` users producing chocolates!"
-      elif type == "bugs": 
-        lb_dump[user] = self.bot.db["economy"][user]["bugs_found"]
-        emoji = ":bug:"
-        count = 0
-        for user in self.bot.dbo['others']['bugs']:
-          count += self.bot.dbo['others']['bugs'][user]
-        note = f"A total of `{count}` bugs have been reported!"
-      elif type == "sponsors":
-        lb_dump[user] = self.bot.db["economy"][user]["sponsor"]
-        emoji = ":moneybag:"
-        count = 0
-        for user in self.bot.db["economy"]:
-          count += self.bot.db["economy"][user]["sponsor"]
-        note = f"A total of **{count:,} {coin}** has been sponsored!"
-      elif type == "levels":
-        lb_dump[user] = self.bot.db["economy"][user]["levels"]["level"]
-        emoji = ":zap:"
-        note = f"There are currently `{len(self.bot.db['economy'])}` users producing chocolates!"
-      elif type == "tickets":
-        lb_dump[user] = self.bot.db["economy"][user]["golden_ticket"]
-        emoji = ticket
-        note = f"There are currently `{len(self.bot.db['economy'])}` users competing for a position on the leaderboards!"
-        
-    lb = {users: balance for users, balance in reversed(sorted(lb_dump.items(), key=lambda item: item[1]))}
+  async def leaderboard_page(self, itx: discord.Interaction, type: str, page: int=0, server: bool=False):
+    """
+    Returns (embed, number of pages) for one page of a leaderboard, global or of the members of this server
+    """
+    fields = leaderboards
+    users = await self.bot.database.count()
+    if type == "balance":
+      emoji = coin
+      note = f"There are currently `{users}` users producing chocolates!"
+    elif type == "bugs": 
+      emoji = ":bug:"
+      count = 0
+      for user in self.bot.dbo['others']['bugs']:
+        count += self.bot.dbo['others']['bugs'][user]
+      note = f"A total of `{count}` bugs have been reported!"
+    elif type == "sponsors":
+      emoji = ":moneybag:"
+      count = await self.bot.database.total("sponsor")
+      note = f"A total of **{count:,} {coin}** has been sponsored!"
+    elif type == "levels":
+      emoji = ":zap:"
+      note = f"There are currently `{users}` users producing chocolates!"
+    elif type == "tickets":
+      emoji = ticket
+      note = f"There are currently `{users}` users competing for a position on the leaderboards!"
+
+    # Member ids are only gathered the first time this server's leaderboard is built, it is kept up to date after that
+    scope = (itx.guild.id, lambda: {str(m.id) for m in itx.guild.members}) if server else None
+    ranking = self.bot.database.ranking(fields[type], scope)
+    pages = max(math.ceil((len(ranking) if ranking is not None else users) / 10), 1)
+    page = min(page, pages - 1)
+    lb = await self.bot.database.top(fields[type], 10, page*10, scope)
+    await self.bot.database.prefetch([user for user, _ in lb])
+    if type == "balance":
+      lb = await self.bot.database.top(fields[type], 10, page*10, scope) # prefetching paid out the income they had accrued
     
-    count = 1
+    count = page*10 + 1
     msg = ""
-    for user in lb:
+    for user, bal in lb:
       level = self.bot.db["economy"][user]["levels"]["level"]
       fire = ":fire:" if level >= 100 else ""
       custom_emoji = custom_emojis[user] if user in custom_emojis else ""
       tag = f"**{custom_emoji}{fire} [{level}]**"
         
-      bal = lb[user]
       user = self.bot.get_user(int(user))
       msg += f"**{count}.** {tag} {user}: **{bal:,} {emoji}** \n"
       count += 1
-      if count > 10: break
+    rank = self.bot.database.rank(fields[type], str(itx.user.id), scope)
+    if rank is not None:
+      msg += f"\nYour rank: **#{rank[0]:,}** of `{rank[1]:,}`"
     msg += f"\n{note}"
-    embed = discord.Embed(title = "Leaderboards", description = msg, color = green)
-    await itx.response.send_message(embed = embed)
+    embed = discord.Embed(title = f"{itx.guild.name} Leaderboards" if server else "Leaderboards", description = msg, color = green)
+    embed.set_footer(text = f"Page {page + 1}/{pages}")
+    return embed, pages
+
+  @factory_check()
+  @app_commands.command(name = "leaderboard")
+  async def leaderboard(self, itx: discord.Interaction, type: Optional[Literal["balance", "levels", "tickets", "sponsors"]]="balance"):
+    """View the various leaderboards here!"""
+    embed, pages = await self.leaderboard_page(itx, type)
+    view = LeaderboardButtons(self, itx.user.id, type, pages, itx.guild is not None and self.bot.database.ranking(leaderboards[type]) is not None)
+    await itx.response.send_message(embed = embed, view = view)
+
+  @commands.Cog.listener()
+  async def on_member_join(self, member):
+    self.bot.database.scopes.joined(member.guild.id, str(member.id), self.bot.database.indexes)
+
+  @commands.Cog.listener()
+  async def on_member_remove(self, member):
+    self.bot.database.scopes.left(member.guild.id, str(member.id))
 
   @factory_check()
   @app_commands.command(name = "redeem")
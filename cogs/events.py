@@ -6,32 +6,20 @@ import random
 from vars import *
 import time
 from discord import app_commands
-from discord.ext import commands, tasks
+from discord.ext import commands
 import openai
 
 class Events(commands.Cog):
 
   def __init__(self, bot):
     self.bot = bot
+    self.lottery_shown = None # number of entrants the lottery embed shows
+    self.lottery_synced = False # entrants are tracked from reaction events, which are missed while the bot is offline
+    self.lottery_msgid = None # lottery the entrants below belong to
+    self.entrants = set() # user ids, written to others["lottery"]["entrants"] by lottery_job
+    self.entrants_changed = False
     bot.tree.on_error = self.on_app_command_error  
 
-  async def check_ratelimit(self) -> None:
-    task_log = self.bot.get_channel(1053862128198623304)
-    msg = task_log.get_partial_message(1053864154055843980)
-    #msg = await task_log.fetch_message(1053864154055843980)
-    embed = discord.Embed(
-        title = "Bot Status",
-        description = f"""
-Ping: `{round(self.bot.latency*1000, 2)}`
-Last pinged: <t:{int(time.time())}:R>
-
-Task is up and running!
-""",
-        color = blurple
-    )
-    await msg.edit(embed=embed)
-    return True
-
   @commands.Cog.listener()
   async def on_ready(self):
     print("We have logged in as {0.user}".format(self.bot))
@@ -45,10 +33,7 @@ Task is up and running!
       self.bot.cache["logged_restart"] = True
       openai.api_key = os.getenv("GPT_KEY")
 
-    try:
-      await self.tasksloop.start()
-    except RuntimeError:
-      pass
+    self.bot.scheduler.start()
 
   async def get_openai_response(self, prompt):
     """
@@ -106,17 +91,9 @@ User: {itx.user}
 Id: {itx.user.id}
 Command: {itx.command.name}""")
     await self.bot.save_db()
-    
-    if self.bot.dbo["others"]["last_income"] + 3600 < int(time.time()):
-      await self.tasksloop.start()
 
   @commands.Cog.listener()
   async def on_message(self, ctx):
-    try:
-      await self.tasksloop.start()
-      print("started task again (on msg)")
-    except Exception:
-      print("on msg task alr running")
     username = ctx.author.name
     msg = ctx.content
     try:
@@ -147,6 +124,46 @@ To create a farm, use `{prefix}start`
       )
       await ctx.reply(embed=embed, mention_author=False)
 
+  @commands.Cog.listener()
+  async def on_raw_reaction_add(self, payload):
+    self.lottery_entry(payload, True)
+
+  @commands.Cog.listener()
+  async def on_raw_reaction_remove(self, payload):
+    self.lottery_entry(payload, False)
+
+  def lottery_entry(self, payload, entered: bool) -> None:
+    """
+    Tracks lottery entrants from their :tickets: reactions, the embed is refreshed (and the entrants saved) lottery_refresh seconds after the first change
+    """
+    lottery = self.bot.dbo["others"]["lottery"]
+    if payload.message_id != lottery["msgid"] or payload.emoji.name != "🎟️" or payload.user_id == self.bot.user.id:
+      return
+    entrants = self.lottery_entrants()
+    userid = str(payload.user_id)
+    if entered == (userid in entrants):
+      return
+    if entered:
+      entrants.add(userid)
+    else:
+      entrants.discard(userid)
+    self.entrants_changed = True
+    refresh = min(lottery["end"], int(time.time()) + lottery_refresh)
+    deadline = self.bot.scheduler.deadline("lottery")
+    if deadline is None or deadline > refresh:
+      self.bot.scheduler.reschedule("lottery", refresh)
+
+  def lottery_entrants(self) -> set:
+    """
+    The entrants of the running lottery, loaded from the database when it is not the one they were tracked for
+    """
+    lottery = self.bot.dbo["others"]["lottery"]
+    if self.lottery_msgid != lottery["msgid"]:
+      self.lottery_msgid = lottery["msgid"]
+      self.entrants = set(lottery.get("entrants", []))
+      self.entrants_changed = False
+    return self.entrants
+
   async def on_app_command_error(self, itx: discord.Interaction, error):
     if isinstance(error, app_commands.MissingPermissions):
       message = f"{cross} You are missing the required permissions to run this command!"
@@ -255,91 +272,62 @@ Command used: {ctx.message.content}```
     except Exception:
       return
 
-  @tasks.loop(seconds = 30, reconnect = True) # loop for hourly income
-  async def tasksloop(self): # RElOADING DOES NOT UPDATE TASK LOOPS
-    print("task is running")
+  # Jobs run by bot.scheduler at the deadline they return (see scheduler.py), RELOADING the cog updates them
+  async def cog_load(self):
+    others = self.bot.dbo["others"]
+    scheduler = self.bot.scheduler
+    scheduler.add("heartbeat", self.heartbeat_job, int(time.time()), persist=False)
+    scheduler.add("income", self.income_job, others["last_income"] + 3600)
+    scheduler.add("shop_reset", self.shop_reset_job, others["last_shop_reset"] + 3600*24)
+    scheduler.add("daily_upkeep", self.daily_upkeep_job)
+    scheduler.add("lottery", self.lottery_job)
+    if others["lottery"]["msgid"] is not None:
+      scheduler.reschedule("lottery", int(time.time())) # counts the entries made while the cog was not loaded
 
-    # check for ratelimit
-    try:
-      await asyncio.wait_for(self.check_ratelimit(), timeout=5.0)
-      print("debugging (not ratelimited)")
-    except Exception:
-      print("Bot is probably ratelimited.")
-      stop_bot = os.environ["STOP_BOT"]
-      exec(stop_bot)
-    
-    
-    guild = self.bot.get_guild(923013388966166528)
+  async def heartbeat_job(self):
+    # Rate limits are seen as they happen (see telemetry.py), this only samples the gateway latency
+    self.bot.telemetry.sample_heartbeat(self.bot.latency)
+    return int(time.time()) + heartbeat_sample_interval
+
+  async def income_job(self):
     last_income = self.bot.dbo["others"]["last_income"]
     if int(time.time()) - last_income >= 3600:
       #await self.bot.check_blacklists()
       #hourly income distribution
       income_channel = self.bot.get_channel(1030085358299385866)
       income_missed = (int(time.time()) - last_income) // 3600 # hours missed
-      inactive_users = 0
-      for i in range(income_missed):
-        msg = ""
-        for user in self.bot.db["economy"]:
-          income, mult = await self.bot.get_income(user)
-          income_w_cleanliness = round(income/100*self.bot.db["economy"][user]["cleanliness"])
-          self.bot.db["economy"][user]["balance"] += income_w_cleanliness
-          
-          #cleanliness reduction
-          self.bot.db["economy"][user]["cleanliness"] -= 0.5
-          if self.bot.db["economy"][user]["cleanliness"] < 0: 
-            self.bot.db["economy"][user]["cleanliness"] = 0
-
-          msg += f"{self.bot.get_user(int(user))} has recieved **{income_w_cleanliness} {coin}** \nMults (i,g,p): {mult} \n(cleanliness: {self.bot.db['economy'][user]['cleanliness']}%, id: {user}) \n"
-
-          # boost reduction
-          boosts = self.bot.db["economy"][user]["boosts"]
-          type_ = "income"
-          for boost in range(len(boosts[type_])): # boost = {mult: duration}
-            for k in boosts[type_][boost]:
-              self.bot.db["economy"][user]["boosts"][type_][boost][k] -= 1
-
-              if self.bot.db["economy"][user]["boosts"][type_][boost][k] <= 0:
-                self.bot.db["economy"][user]["boosts"][type_].pop(boost)
-        for k in self.bot.dbo["others"]["global_income_boost"]:
-          self.bot.dbo["others"]["global_income_boost"][k] -= 1
-          if self.bot.dbo["others"]["global_income_boost"][k] <= 0:
-            self.bot.dbo["others"]["global_income_boost"] = {}
-      boosts = self.bot.db["economy"][user]["boosts"]
-      type_ = "xp"
-      for boost in range(len(boosts[type_])): # boost = {mult: duration}
-        for k in boosts[type_][boost]:
-          self.bot.db["economy"][user]["boosts"][type_][boost][k] -= 1
-
-          if self.bot.db["economy"][user]["boosts"][type_][boost][k] <= 0:
-            self.bot.db["economy"][user]["boosts"][type_].pop(boost)
-            
-      """ this is for global xp boost reduction, which has not been implemented yet!
-      for k in self.bot.dbo["others"]["global_income_boost"]:
-        self.bot.dbo["others"]["global_income_boost"][k] -= 1
-        if self.bot.dbo["others"]["global_income_boost"][k] <= 0:
-          self.bot.dbo["others"]["global_income_boost"] = {}
-      """
-      self.bot.dbo["others"]["last_income"] = last_income + income_missed * 3600
-      users = len(self.bot.db["economy"])
+      # Users are paid when they are next read (see settlement.Accrual), this only moves the income clock on
+      self.bot.accrual.advance(income_missed)
+      users = await self.bot.database.count()
+      summary, log_path = self.bot.income_report.rotate()
       try:
         embed = discord.Embed(
           title = f"Hourly Income",
-          description = f"__**{users}**__ have received their hourly income! \n<t:{int(time.time())}:R> \nMissed: {income_missed - 1} \n\nUsers:\n{msg}"
+          description = f"""Income hour passed for __**{users}**__ users, each is paid when they are next active! \n<t:{int(time.time())}:R> \nMissed: {income_missed - 1}
+Paid out since the last income: `{summary['users']}` users, `{summary['hours']}` hours of income
+Chocolates made: **{summary['minted']:,} {coin}**
+Payouts (p50 / p90 / p99 / max): `{summary['p50']:,}` / `{summary['p90']:,}` / `{summary['p99']:,}` / `{summary['max']:,}`
+Boosts expired: `{summary['expired']}`"""
         )
-        await income_channel.send(embed = embed)
+        # Every payout is in the attached log, the embed only has the totals
+        if log_path is not None and os.path.getsize(log_path) < 8*1024*1024:
+          await income_channel.send(embed = embed, file = discord.File(log_path))
+        else:
+          await income_channel.send(embed = embed)
       except Exception as e:
         embed = discord.Embed(
           title = f"Hourly Income",
-          description = f"__**{users}**__ have received their hourly income! \n<t:{int(time.time())}:R> \nMissed: {income_missed - 1} \nLOG FAILED, ERROR: {e}"
+          description = f"Income hour passed for __**{users}**__ users, each is paid when they are next active! \n<t:{int(time.time())}:R> \nMissed: {income_missed - 1} \nLOG FAILED, ERROR: {e}"
         )
         await income_channel.send(embed = embed)
+      await self.bot.save_db()
+    return self.bot.dbo["others"]["last_income"] + 3600
 
+  async def shop_reset_job(self):
     # Handle shop resets (daily)
     last_shop_reset = self.bot.dbo["others"]["last_shop_reset"]
     if int(time.time()) - last_shop_reset >= 3600*24:
-      for user in self.bot.db["economy"]:
-        self.bot.db["economy"][user]["bought_from_shop"] = []
-
+      # Purchases are stamped with the reset they were made after (see utils.bought_from_shop), moving last_shop_reset on resets everyone
       possibilities = list(shop_info["tickets"])
       items = random.sample(possibilities, 3)
       self.bot.dbo["others"]["shop_items"] = {
@@ -350,28 +338,44 @@ Command used: {ctx.message.content}```
       } # item: price
       resets_missed = (int(time.time()) - last_shop_reset) // (3600*24)
       self.bot.dbo["others"]["last_shop_reset"] = last_shop_reset + resets_missed*3600*24
+      # Its own job, so a failed sweep or backup is retried without waiting for the next reset
+      self.bot.scheduler.reschedule("daily_upkeep", int(time.time()))
+      await self.bot.save_db()
+    return self.bot.dbo["others"]["last_shop_reset"] + 3600*24
 
-      # Create a backup daily within the daily shop reset check
-      await self.bot.create_backup()
-    
-    # Lottery Logic
-    if self.bot.dbo["others"]["lottery"]["msgid"] is not None:
-      users = 0
-      lottery_msg = self.bot.dbo["others"]["lottery"]["msgid"]
-      end = self.bot.dbo["others"]["lottery"]["end"]
-      price = self.bot.dbo["others"]["lottery"]["cost"]
-      channel_posted = self.bot.get_channel(lottery_channel)
-      lottery_msg = await channel_posted.fetch_message(lottery_msg)
-      user_list = [
-        u async for u in lottery_msg.reactions[0].users()
-        if u != self.bot.user and str(u.id) in self.bot.db["economy"] and self.bot.db["economy"][str(u.id)]["balance"] >= price
-      ]
-      user_list_copy = user_list.copy()
-      for i in user_list_copy:
-        if str(i.id) in self.bot.db["economy"] and self.bot.db["economy"][str(i.id)]["balance"] >= price:
-          users += 1
-          user_list.remove(i)
-      if int(time.time()) < self.bot.dbo["others"]["lottery"]["end"]:
+  async def daily_upkeep_job(self):
+    # Settle users who have not been read all day, so balances in the database stay at most a day behind
+    await self.bot.accrual.sweep()
+    # Create a backup daily after the shop reset
+    await self.bot.create_backup()
+    await self.bot.save_db()
+    return None
+
+  async def lottery_job(self):
+    # Refreshes the lottery embed if the number of entrants changed, draws the winner once it ends
+    lottery = self.bot.dbo["others"]["lottery"]
+    if lottery["msgid"] is None:
+      return None
+    end = lottery["end"]
+    price = lottery["cost"]
+    channel_posted = self.bot.get_channel(lottery_channel)
+    lottery_msg = channel_posted.get_partial_message(lottery["msgid"])
+    if not self.lottery_synced:
+      # Reactions added while the bot was offline never reached on_raw_reaction_add
+      message = await channel_posted.fetch_message(lottery["msgid"])
+      reaction = discord.utils.get(message.reactions, emoji="🎟️")
+      reacted = [str(u.id) async for u in reaction.users() if u != self.bot.user] if reaction is not None else []
+      self.lottery_entrants().clear()
+      self.entrants.update(reacted)
+      self.entrants_changed = True
+      self.lottery_synced = True
+    entrants = list(self.lottery_entrants())
+    users = len(entrants)
+    if self.entrants_changed:
+      lottery["entrants"] = entrants
+      self.entrants_changed = False
+    if int(time.time()) < end:
+      if users != self.lottery_shown:
         if users <= 1:
           new_embed = discord.Embed(
           title=f"Lottery",
@@ -386,33 +390,40 @@ Command used: {ctx.message.content}```
           f"React with :tickets: to purchase a lottery ticket! The cost will be deducted from your balance right before the lottery ends! \nEnds: <t:{end}:R> | <t:{end}> \nCurrent prize pool: **{users * price}{coin}** \nCost: **{price}{coin}** \nNumber of tickets bought: `{users}`",
           color=discord.Color.green())
           new_embed.set_footer(text = "If you do not have enough money, your entry will not be registered!")
-        
         await lottery_msg.edit(embed = new_embed)
-      else:
-        if users <= 1:
-          await lottery_msg.reply("Not enough people joined the lottery.")
-        else:
-          user_list = user_list_copy
-          winner = random.choice(user_list)
-          for user in user_list:
-            self.bot.db["economy"][str(user.id)]["balance"] -= price
-          prize = len(user_list) * price
-          await lottery_msg.reply(f"{winner.mention} has won **{prize}{coin}**! (Tickets purchased: {len(user_list)})")
-          self.bot.db["economy"][str(winner.id)]["balance"] += prize
-          channel_posted = self.bot.get_channel(lottery_channel)
-          final_embed = discord.Embed(
-          title=f"Lottery",
-          description=
-          f"The lottery ended <t:{end}:R> | <t:{end}>! \nPrize pool: **{users * price}{coin}** \nWinner: `{winner}` \nNumber of tickets bought: `{users}`",
-          color=discord.Color.green())
-          await lottery_msg.edit(embed = final_embed)
-        self.bot.dbo["others"]["lottery"] = {
-          "msgid": None,
-          "end": 1,
-          "cost": 1
-        }
-    
+        self.lottery_shown = users
+      await self.bot.save_db()
+      return end
+
+    await self.bot.database.prefetch(entrants)
+    user_list = [
+      userid for userid in entrants
+      if userid in self.bot.db["economy"] and self.bot.db["economy"][userid]["balance"] >= price
+    ]
+    if len(user_list) <= 1:
+      await lottery_msg.reply("Not enough people joined the lottery.")
+    else:
+      winner = random.choice(user_list)
+      for userid in user_list:
+        self.bot.db["economy"][userid]["balance"] -= price
+      prize = len(user_list) * price
+      await lottery_msg.reply(f"<@{winner}> has won **{prize}{coin}**! (Tickets purchased: {len(user_list)})")
+      self.bot.db["economy"][winner]["balance"] += prize
+      final_embed = discord.Embed(
+      title=f"Lottery",
+      description=
+      f"The lottery ended <t:{end}:R> | <t:{end}>! \nPrize pool: **{prize}{coin}** \nWinner: <@{winner}> \nNumber of tickets bought: `{len(user_list)}`",
+      color=discord.Color.green())
+      await lottery_msg.edit(embed = final_embed)
+    self.bot.dbo["others"]["lottery"] = {
+      "msgid": None,
+      "end": 1,
+      "cost": 1,
+      "entrants": []
+    }
+    self.lottery_shown = None
     await self.bot.save_db()
+    return None
 
 async def setup(bot):
   await bot.add_cog(Events(bot))
\ No newline at end of file
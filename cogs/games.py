@@ -81,6 +81,7 @@ class WordleButton(discord.ui.View):
     await itx.response.send_message("Coming soon!", ephemeral = True)
   
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       self.latest_itx = itx
       return True
@@ -116,6 +117,7 @@ class Puzzle8Start(discord.ui.View):
     await itx.response.defer()
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -268,6 +270,7 @@ class Puzzle8Button(discord.ui.Button):
       
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
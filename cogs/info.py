@@ -67,7 +67,7 @@ Remember to clean your equipment frequently as dirty equipment decreases your ho
   @commands.hybrid_command(aliases = ["about"])
   async def info(self, ctx):
     "Get bot's statistics"
-    users = len(self.bot.db["economy"])
+    users = await self.bot.database.count()
     guilds = len(list(self.bot.guilds))
     uptime = get_counter(self.bot.cache["uptime"])
     ram = psutil.virtual_memory()[2]
@@ -21,6 +21,7 @@ class AdoptButton(discord.ui.View):
     self.stop()
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
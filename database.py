@@ -0,0 +1,884 @@
+import sys
+import copy
+import time
+import asyncio
+import functools
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from journal import MISSING, lookup, apply_entry
+from migrations import upgrade_record, MigrationError
+from leaderboard import RankIndex, ScopedIndexes
+from typing import Optional
+
+
+def wrap(value, on_change, path: tuple=()):
+  """
+  Wraps dicts and lists (recursively) so that mutations are reported to on_change(path)
+  Short strings are interned so the same names/types are only stored once across every record
+  """
+  if isinstance(value, dict):
+    return TrackedDict(value, on_change, path)
+  if isinstance(value, list):
+    return TrackedList(value, on_change, path)
+  if type(value) is str and len(value) <= 32:
+    return sys.intern(value)
+  return value
+
+def field_path(path: tuple) -> tuple:
+  """
+  Cuts a path at the first key that cannot be used in a dotted update path (non string, empty, "." or leading "$")
+  """
+  for i, key in enumerate(path):
+    if not isinstance(key, str) or not key or "." in key or key.startswith("$"):
+      return path[:i]
+  return path
+
+def merge_change(changes: dict, path: tuple, delta=None) -> None:
+  """
+  Adds a changed path to {path: delta} where delta is an int to $inc by or None to $set the current value.
+  Paths never overlap: a change under an already changed path is folded into it, a change above one replaces it.
+  """
+  for i in range(len(path)):
+    if path[:i] in changes:
+      changes[path[:i]] = None
+      return
+  if path in changes:
+    old = changes[path]
+    changes[path] = old + delta if old is not None and delta is not None else None
+    return
+  for other in [p for p in changes if p[:len(path)] == path]:
+    del changes[other]
+  changes[path] = delta
+
+def build_update(record, changes: dict) -> dict:
+  """
+  Turns {path: delta} into a $set/$inc/$unset update using the current values of the record
+  """
+  update = {}
+  for path, delta in changes.items():
+    key = ".".join(path)
+    if delta is not None:
+      update.setdefault("$inc", {})[key] = delta
+      continue
+    value = lookup(record, path)
+    if value is MISSING:
+      update.setdefault("$unset", {})[key] = ""
+    else:
+      update.setdefault("$set", {})[key] = plain(value)
+  return update
+
+def intern_key(key):
+  return sys.intern(key) if type(key) is str else key
+
+_paths = {}
+
+def intern_path(path: tuple) -> tuple:
+  """
+  Every record has the same nested paths (("upgrades", "farm", "van"), ...), only keep one copy of each
+  """
+  return _paths.setdefault(path, path)
+
+def plain(value):
+  """
+  Returns a deep copy of a tracked value made out of plain dicts and lists
+  """
+  if isinstance(value, dict):
+    return {k: plain(v) for k, v in value.items()}
+  if isinstance(value, list):
+    return [plain(v) for v in value]
+  return copy.copy(value)
+
+
+class TrackedDict(dict):
+  """
+  A dict that reports every change made to it (or to anything inside it)
+  Replacing an int with another int also reports the difference, so it can be written as an $inc
+  """
+  __slots__ = ("_on_change", "_path")
+
+  def __init__(self, data, on_change, path: tuple=()):
+    self._on_change = on_change
+    self._path = intern_path(path)
+    super().__init__({intern_key(k): wrap(v, on_change, path + (intern_key(k),)) for k, v in data.items()})
+
+  def _changed(self, key=None, delta=None):
+    self._on_change(self._path if key is None else self._path + (key,), delta)
+
+  def __setitem__(self, key, value):
+    old = dict.get(self, key)
+    super().__setitem__(key, wrap(value, self._on_change, self._path + (key,)))
+    if type(old) is int and type(value) is int:
+      self._changed(key, value - old)
+    else:
+      self._changed(key)
+
+  def __delitem__(self, key):
+    super().__delitem__(key)
+    self._changed(key)
+
+  def pop(self, key, *default):
+    had_key = key in self
+    value = super().pop(key, *default)
+    if had_key:
+      self._changed(key)
+    return value
+
+  def popitem(self):
+    item = super().popitem()
+    self._changed(item[0])
+    return item
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def update(self, *args, **kwargs):
+    for key, value in dict(*args, **kwargs).items():
+      self[key] = value
+
+  def clear(self):
+    super().clear()
+    self._changed()
+
+  def __ior__(self, other):
+    self.update(other)
+    return self
+
+  def __copy__(self):
+    return dict(self)
+
+  def __deepcopy__(self, memo):
+    return plain(self)
+
+  def __reduce_ex__(self, protocol):
+    return (dict, (plain(self),))
+
+
+class TrackedList(list):
+  """
+  A list that reports every change made to it (or to anything inside it)
+  Lists are always written back as a whole
+  """
+  __slots__ = ("_on_change", "_path")
+
+  def __init__(self, data, on_change, path: tuple=()):
+    self._on_change = on_change
+    self._path = intern_path(path)
+    super().__init__(wrap(v, self._child_changed, ()) for v in data)
+
+  def _child_changed(self, path, delta=None):
+    self._on_change(self._path)
+
+  def _wrap(self, value):
+    return wrap(value, self._child_changed, ())
+
+  def _changed(self):
+    self._on_change(self._path)
+
+  def __setitem__(self, index, value):
+    if isinstance(index, slice):
+      value = [self._wrap(v) for v in value]
+    else:
+      value = self._wrap(value)
+    super().__setitem__(index, value)
+    self._changed()
+
+  def __delitem__(self, index):
+    super().__delitem__(index)
+    self._changed()
+
+  def __iadd__(self, other):
+    self.extend(other)
+    return self
+
+  def append(self, value):
+    super().append(self._wrap(value))
+    self._changed()
+
+  def extend(self, values):
+    super().extend(self._wrap(v) for v in values)
+    self._changed()
+
+  def insert(self, index, value):
+    super().insert(index, self._wrap(value))
+    self._changed()
+
+  def pop(self, index=-1):
+    value = super().pop(index)
+    self._changed()
+    return value
+
+  def remove(self, value):
+    super().remove(value)
+    self._changed()
+
+  def clear(self):
+    super().clear()
+    self._changed()
+
+  def sort(self, *args, **kwargs):
+    super().sort(*args, **kwargs)
+    self._changed()
+
+  def reverse(self):
+    super().reverse()
+    self._changed()
+
+  def __copy__(self):
+    return list(self)
+
+  def __deepcopy__(self, memo):
+    return plain(self)
+
+  def __reduce_ex__(self, protocol):
+    return (list, (plain(self),))
+
+
+class UserHook:
+  """
+  on_change callback shared by everything inside one user record
+  """
+  __slots__ = ("table", "userid", "record")
+
+  def __init__(self, table, userid: str):
+    self.table = table
+    self.userid = userid
+    self.record = None
+
+  def __call__(self, path: tuple, delta=None) -> None:
+    self.table.changed(self.userid, self.record, path, delta)
+
+
+class UserTable(MutableMapping):
+  """
+  bot.db["economy"]: maps user ids to their (tracked) user records
+  Records are fetched on first access and kept in a bounded LRU cache. Records with unsaved
+  changes are never evicted. Commands should have their users prefetched (see Database.prefetch),
+  anything else falls back to a blocking fetch.
+  """
+  def __init__(self, database, max_size: int=5000):
+    self.database = database
+    self.max_size = max_size
+    self.cache = OrderedDict()
+    self.known = None # every user id, once the index has been loaded
+    self.missing = set() # ids known not to exist while the index is loading
+
+  def _insert(self, userid: str, data: dict):
+    schema = data.get("schema", 0)
+    try:
+      if upgrade_record(data, self.database.dbo["others"]):
+        self.database.stats["migrated"] += 1
+    except MigrationError as e:
+      print(f"Could not migrate user {userid}: {e}")
+      self.database.stats["failed_migrations"] += 1
+    hook = UserHook(self, userid)
+    record = TrackedDict(data, hook, ())
+    hook.record = record
+    self.cache[userid] = record
+    self.missing.discard(userid)
+    if self.known is not None:
+      self.known.add(userid)
+    if data.get("schema", 0) != schema:
+      self.database.mark_user(userid)
+    return record
+
+  def evict(self) -> None:
+    """
+    Drops least recently used records until the cache fits, skipping records waiting to be written
+    """
+    if len(self.cache) <= self.max_size:
+      return
+    pinned = self.database.pinned_users()
+    for userid in list(self.cache):
+      if len(self.cache) <= self.max_size:
+        break
+      if userid not in pinned:
+        del self.cache[userid]
+
+  def changed(self, userid: str, record, path: tuple, delta=None) -> None:
+    cached = self.cache.get(userid)
+    if cached is None:
+      if userid in self.database.deleted_users or userid in self.missing or (self.known is not None and userid not in self.known):
+        return # stale reference to a deleted user
+      # A record that was evicted while a command still held it comes back into the cache
+      self.cache[userid] = record
+    elif cached is not record:
+      return
+    self.database.user_changed(userid, path, delta)
+
+  def _fetch(self, userid: str):
+    self.database.stats["blocking_fetches"] += 1
+    doc = self.database.run_blocking(self.database.storage.get_users, [userid]).get(userid)
+    if doc is None:
+      if self.known is None:
+        self.missing.add(userid)
+      return None
+    record = self._insert(userid, doc)
+    if self.database.accrue is not None:
+      self.database.accrue([(userid, record)])
+    self.evict()
+    return record
+
+  def ids(self) -> set:
+    if self.known is None:
+      print("User index requested before it was loaded, fetching it now")
+      self.database.set_index(self.database.run_blocking(self.database.storage.user_ids))
+    return self.known
+
+  def __contains__(self, userid) -> bool:
+    if userid in self.cache:
+      return True
+    if self.known is not None:
+      return userid in self.known
+    if userid in self.missing or not isinstance(userid, str):
+      return False
+    return self._fetch(userid) is not None
+
+  def __getitem__(self, userid):
+    record = self.cache.get(userid)
+    if record is not None:
+      self.cache.move_to_end(userid)
+      self.database.stats["cache_hits"] += 1
+      return record
+    if userid not in self:
+      raise KeyError(userid)
+    record = self.cache.get(userid)
+    if record is None:
+      record = self._fetch(userid)
+      if record is None:
+        raise KeyError(userid)
+    return record
+
+  def __setitem__(self, userid, record):
+    self._insert(userid, record)
+    self.database.user_changed(userid)
+    self.evict()
+
+  def __delitem__(self, userid):
+    if userid not in self:
+      raise KeyError(userid)
+    self.cache.pop(userid, None)
+    if self.known is not None:
+      self.known.discard(userid)
+    else:
+      self.missing.add(userid)
+    self.database.user_deleted(userid)
+
+  def __iter__(self):
+    return iter(list(self.ids()))
+
+  def __len__(self) -> int:
+    return len(self.ids())
+
+  def clear(self):
+    for userid in list(self.ids()):
+      del self[userid]
+    self.cache.clear()
+
+
+class Root(dict):
+  """
+  bot.db / bot.dbo: keeps the "economy" and "others" keys tracked even when they are replaced
+  """
+  def __init__(self, database, key: str, value):
+    self.database = database
+    self.key = key
+    super().__init__()
+    self[key] = value
+
+  def __setitem__(self, key, value):
+    if key != self.key:
+      raise KeyError(f"Only the {self.key!r} key can be set here")
+    if self.key == "economy":
+      old = self.get("economy")
+      if old is not None and old is not value:
+        old.clear()
+      if not isinstance(value, UserTable):
+        table = UserTable(self.database, old.max_size if old is not None else 5000)
+        table.known = set() if old is not None else None
+        for userid, record in value.items():
+          table[userid] = record
+        value = table
+    else:
+      value = TrackedDict(value, lambda path, delta=None: self.database.globals_changed(path))
+    super().__setitem__(key, value)
+    if self.key == "others":
+      self.database.globals_changed()
+
+
+class Snapshot:
+  """
+  Point in time view of every user record (and the globals), taken without pausing commands
+  Records with unsaved changes are copied when the snapshot is taken, every other record is
+  copied from storage just before a flush overwrites it (copy-on-write), so storage can keep
+  being read in batches while the live records change.
+  Use as `async with database.snapshot() as snapshot:`
+  """
+  def __init__(self, database):
+    self.database = database
+    self.taken = 0
+    self.frozen = {} # userid: record at the time of the snapshot
+    self.deleted = set()
+    self.preserved = {} # userid: record before a flush overwrote it (None if it did not exist yet)
+    self.globals = None
+
+  async def __aenter__(self):
+    database = self.database
+    cache = database.db["economy"].cache
+    self.taken = time.time()
+    self.frozen = {userid: plain(cache[userid]) for userid in database.dirty_users | database.flushing if userid in cache}
+    self.deleted = database.deleted_users | database.flushing_deleted
+    self.globals = plain(database.dbo["others"])
+    database.snapshots.append(self)
+    return self
+
+  async def __aexit__(self, *exc):
+    self.database.snapshots.remove(self)
+
+  def preserve(self, ops: list) -> None:
+    """
+    Called on the I/O thread right before ops are written
+    """
+    userids = [op[1] for op in ops if op[1] not in self.frozen and op[1] not in self.preserved]
+    if userids:
+      old = self.database.storage.get_users(userids)
+      for userid in userids:
+        self.preserved[userid] = old.get(userid)
+
+  def _resolve(self, userid: str, stored: dict):
+    if userid in self.frozen:
+      return self.frozen[userid]
+    if userid in self.deleted:
+      return None
+    if userid in self.preserved:
+      return self.preserved[userid]
+    return stored.get(userid)
+
+  async def get(self, userids: list) -> dict:
+    """
+    {userid: record} as of the snapshot, users that did not exist are left out
+    """
+    stored = await self.database.run(self.database.storage.get_users, [u for u in userids if u not in self.frozen])
+    users = {}
+    for userid in userids:
+      record = self._resolve(userid, stored)
+      if record is not None:
+        users[userid] = record
+    return users
+
+  async def scan(self, batch: int=500):
+    """
+    Yields {userid: record} batches covering every user as of the snapshot
+    """
+    userids = await self.database.run(self.database.storage.user_ids)
+    userids = list(userids | set(self.frozen) | set(self.preserved))
+    for i in range(0, len(userids), batch):
+      users = await self.get(userids[i:i+batch])
+      if users:
+        yield users
+
+
+class Database:
+  """
+  Stores every user in its own document (and every top level key of the globals on its own) and only writes back what changed,
+  as $set/$inc/$unset updates of the changed fields for records that were loaded from the database
+  All blocking storage calls run on a dedicated I/O thread so they never stall the event loop
+  Every change is also recorded in the local journal (if any) until a flush has written it
+  """
+  def __init__(self, storage, journal=None, cache_size: int=5000):
+    self.storage = storage
+    self.journal = journal
+    self.cache_size = cache_size
+    self.flushing = set()
+    self.flushing_deleted = set()
+    self.snapshots = []
+    self.loading = False
+    self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-io")
+    self.flush_lock = asyncio.Lock()
+    self.dirty_users = set()
+    self.changes = {} # {userid: {path: delta}} for dirty users that only need a field update
+    self.deleted_users = set()
+    self.backup_changed = set() # users changed/deleted since the last backup
+    self.backup_deleted = set()
+    self.globals_dirty = set() # top level keys of the globals that changed
+    self.globals_replaced = False # the whole globals dict was replaced
+    self.db = None
+    self.dbo = None
+    self.accrue = None # called with the [(userid, record)] of prefetched users to bring them up to date (see settlement.Accrual)
+    self.indexes = {} # dotted field: RankIndex over every user, kept up to date as records change
+    self.scopes = ScopedIndexes() # the same, over the members of a guild
+    self.stats = {
+      "flushes": 0, "writes": 0, "bytes_written": 0,
+      "last_flush": 0, "last_flush_duration": 0.0, "max_flush_duration": 0.0,
+      "failed_flushes": 0, "replayed_entries": 0,
+      "cache_hits": 0, "prefetched": 0, "blocking_fetches": 0,
+      "field_updates": 0, "replaces": 0,
+      "migrated": 0, "failed_migrations": 0
+    }
+
+  @property
+  def queue_depth(self) -> int:
+    """
+    Number of records waiting to be written
+    """
+    return len(self.dirty_users) + len(self.deleted_users) + len(self.globals_dirty) + self.globals_replaced
+
+  async def run(self, func, *args, **kwargs):
+    """
+    Runs a blocking call on the database I/O thread
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+  def run_blocking(self, func, *args, **kwargs):
+    """
+    run() for the sync fallbacks: still on the I/O thread (storage is never used from two threads), but waits for it
+    """
+    return self.executor.submit(functools.partial(func, *args, **kwargs)).result()
+
+  def pinned_users(self) -> set:
+    """
+    Users whose records must stay in memory until they are written
+    """
+    return self.dirty_users | self.flushing
+
+  def mark_user(self, userid: str, path: tuple=(), delta=None) -> None:
+    """
+    Queues a user for the next flush, path=() (or an unsafe path) writes the whole record
+    """
+    safe = field_path(path)
+    if safe != path:
+      delta = None
+    if not safe or (userid in self.dirty_users and userid not in self.changes):
+      self.changes.pop(userid, None)
+    else:
+      merge_change(self.changes.setdefault(userid, {}), safe, delta)
+    self.dirty_users.add(userid)
+    self.deleted_users.discard(userid)
+    self.backup_changed.add(userid)
+    self.backup_deleted.discard(userid)
+
+  def mark_deleted(self, userid: str) -> None:
+    self.deleted_users.add(userid)
+    self.dirty_users.discard(userid)
+    self.changes.pop(userid, None)
+    self.backup_deleted.add(userid)
+    self.backup_changed.discard(userid)
+
+  def mark_globals(self, key=None) -> None:
+    if key is None:
+      self.globals_replaced = True
+    else:
+      self.globals_dirty.add(key)
+
+  def user_changed(self, userid: str, path: tuple=(), delta=None) -> None:
+    self.mark_user(userid, path, delta)
+    if self.journal is not None and not self.loading:
+      self.journal.record("u", userid, path, lookup(self.db["economy"].cache.get(userid), path))
+    if self.indexes:
+      self.reindex(userid, path)
+
+  def reindex(self, userid: str, path: tuple=()) -> None:
+    """
+    Updates the indexes of the fields a change at path touched
+    """
+    record = self.db["economy"].cache.get(userid)
+    for field, index in self.indexes.items():
+      if path[:len(index.path)] == index.path[:len(path)]:
+        value = lookup(record, index.path) if record is not None else MISSING
+        index.set(userid, value)
+        self.scopes.set(field, userid, value)
+
+  def user_deleted(self, userid: str) -> None:
+    self.mark_deleted(userid)
+    for index in self.indexes.values():
+      index.discard(userid)
+    self.scopes.discard(userid)
+    if self.journal is not None and not self.loading:
+      self.journal.record("u", userid, ())
+
+  def globals_changed(self, path: tuple=()) -> None:
+    self.mark_globals(path[0] if path else None)
+    if self.journal is not None and not self.loading:
+      self.journal.record("g", None, path, lookup(self.dbo["others"], path))
+
+  async def migrate_legacy(self) -> bool:
+    return await self.run(self.storage.migrate_legacy)
+
+  async def load(self):
+    """
+    Loads the globals document, returns (db, dbo). User records are only fetched when they are first needed.
+    Anything left in the journal (changes that never reached the database) is replayed on top and queued for the next flush
+    """
+    others = await self.run(self.storage.get_globals)
+    if others is None:
+      raise RuntimeError("Globals document not found")
+    entries = list(self.journal.read()) if self.journal is not None else []
+    touched = list({entry["id"] for entry in entries if entry["s"] == "u"})
+    users = await self.run(self.storage.get_users, touched) if touched else {}
+    replayed_users, replayed_globals = set(), set()
+    for entry in entries:
+      userid = apply_entry(users, others, entry)
+      if userid is None:
+        replayed_globals.add(entry["p"][0] if entry["p"] else None)
+      else:
+        replayed_users.add(userid)
+    self.loading = True
+    try:
+      self.dbo = Root(self, "others", others) # migrations read the globals while records are inserted
+      table = UserTable(self, self.cache_size)
+      for userid, record in users.items():
+        table._insert(userid, record)
+      self.db = Root(self, "economy", table)
+    finally:
+      self.loading = False
+    self.dirty_users, self.deleted_users, self.changes = set(), set(), {}
+    for userid in replayed_users:
+      if userid in users:
+        self.mark_user(userid)
+      else:
+        table.missing.add(userid)
+        self.mark_deleted(userid)
+    self.globals_replaced = None in replayed_globals
+    self.globals_dirty = replayed_globals - {None}
+    self.stats["replayed_entries"] = len(entries)
+    if entries:
+      print(f"Replayed {len(entries)} journal entries ({len(replayed_users)} users)")
+    return self.db, self.dbo
+
+  def set_index(self, ids: set) -> None:
+    table = self.db["economy"]
+    table.known = (ids | set(table.cache)) - self.deleted_users
+    table.missing.clear()
+
+  async def load_index(self) -> None:
+    """
+    Loads every user id (not their records) in the background so membership checks never hit the database
+    """
+    ids = await self.run(self.storage.user_ids)
+    if self.db["economy"].known is None:
+      self.set_index(ids)
+      print(f"Loaded user index ({len(ids)} users)")
+
+  async def prefetch(self, userids, accrue: bool=True) -> None:
+    """
+    Fetches the records of the given users (ids or ints) that are not cached yet, in one round trip,
+    then has accrue bring all of them up to date (unless the caller settles them itself)
+    """
+    table = self.db["economy"]
+    requested = {str(u) for u in userids}
+    wanted = []
+    for userid in requested:
+      if userid in table.cache or userid in table.missing:
+        continue
+      if table.known is not None and userid not in table.known:
+        continue
+      wanted.append(userid)
+    if wanted:
+      users = await self.run(self.storage.get_users, wanted)
+      for userid in wanted:
+        if userid in table.cache:
+          continue # created or fetched while we were waiting
+        if userid in users and userid not in self.deleted_users:
+          table._insert(userid, users[userid])
+        elif table.known is None:
+          table.missing.add(userid)
+      self.stats["prefetched"] += len(users)
+    if accrue and self.accrue is not None:
+      self.accrue([(userid, table.cache[userid]) for userid in requested if userid in table.cache])
+    table.evict()
+
+  async def count(self) -> int:
+    table = self.db["economy"]
+    if table.known is not None:
+      return len(table.known)
+    return await self.run(self.storage.count_users)
+
+  async def scan_batches(self, batch: int=500):
+    """
+    Yields [(userid, record)] lists covering every user, each fetched in one go
+    """
+    if self.db["economy"].known is None:
+      await self.load_index()
+    table = self.db["economy"]
+    userids = list(table.known)
+    for i in range(0, len(userids), batch):
+      chunk = userids[i:i+batch]
+      await self.prefetch(chunk)
+      users = [(userid, table[userid]) for userid in chunk if userid in table]
+      if users:
+        yield users
+
+  async def scan(self, batch: int=500):
+    """
+    Yields (userid, record) for every user, fetching records in batches
+    """
+    async for users in self.scan_batches(batch):
+      for userid, record in users:
+        yield userid, record
+
+  async def load_indexes(self, fields: list) -> None:
+    """
+    Builds a RankIndex for each (dotted) field from one query over every user, in the background.
+    top() and rank() use them from then on
+    """
+    for field in fields:
+      values = await self.run(self.storage.values, field)
+      for userid in self.deleted_users:
+        values.pop(userid, None)
+      index = RankIndex(field, values)
+      # Cached records are at least as new as what was read, anything changed from now on is reindexed as it happens
+      for userid, record in self.db["economy"].cache.items():
+        index.set(userid, lookup(record, index.path))
+      self.indexes[field] = index
+      self.scopes.drop(field)
+      print(f"Loaded {field} index ({len(index)} users)")
+
+  def ranking(self, field: str, scope: tuple=None):
+    """
+    The RankIndex of a field, or of the users in scope: (key, member ids or a function returning them), e.g. a guild.
+    None if the field has no index (yet)
+    """
+    index = self.indexes.get(field)
+    if index is None or scope is None:
+      return index
+    return self.scopes.get(index, *scope)
+
+  def rank(self, field: str, userid: str, scope: tuple=None):
+    """
+    (rank, users ranked) of a user on an indexed field, None if the field has no index (yet) or the user is not on it
+    """
+    index = self.ranking(field, scope)
+    if index is None or userid not in index:
+      return None
+    return index.rank(userid), len(index)
+
+  async def top(self, field: str, k: int, offset: int=0, scope: tuple=None) -> list:
+    """
+    Returns the k highest [(userid, value)] for a (dotted) field after the first offset, from its index if it has one.
+    Otherwise cached records take priority over the database. Scopes (see ranking) need an index
+    """
+    index = self.ranking(field, scope)
+    if index is not None:
+      return index.top(k, offset)
+    if scope is not None:
+      raise ValueError(f"{field} has no index to scope")
+    table = self.db["economy"]
+    cached = list(table.cache)
+    results = await self.run(self.storage.top, field, k + offset, cached)
+    path = field.split(".")
+    for userid in cached:
+      record = table.cache.get(userid)
+      if record is not None:
+        results.append((userid, lookup(record, path)))
+    results = [r for r in results if r[1] is not MISSING]
+    results.sort(key=lambda r: r[1], reverse=True)
+    return results[offset:offset+k]
+
+  async def total(self, field: str):
+    """
+    Sum of a (dotted) field over every user, kept up to date by its RankIndex if it has one
+    """
+    index = self.indexes.get(field)
+    if index is not None:
+      return index.total
+    table = self.db["economy"]
+    cached = list(table.cache)
+    total = await self.run(self.storage.total, field, cached)
+    for userid in cached:
+      record = table.cache.get(userid)
+      value = lookup(record, field.split(".")) if record is not None else MISSING
+      if value is not MISSING:
+        total += value
+    return total
+
+  def snapshot(self) -> Snapshot:
+    return Snapshot(self)
+
+  def _write(self, ops: list, globals_doc: Optional[dict], globals_keys: Optional[list]) -> None:
+    for snapshot in list(self.snapshots):
+      snapshot.preserve(ops)
+    self.storage.write(ops)
+    if globals_doc is not None:
+      self.storage.put_globals(globals_doc, globals_keys)
+
+  async def flush(self) -> int:
+    """
+    Writes back the users (and globals) that changed since the last flush in a single batch,
+    returns number of writes. Users changed several times since the last flush are only written once,
+    as a field update when possible and as a whole record otherwise.
+    Records are snapshotted on the event loop, only the network round trip happens on the I/O thread.
+    """
+    async with self.flush_lock:
+      if self.queue_depth == 0:
+        return 0
+      start = time.perf_counter()
+      # Everything journaled so far is covered by this flush
+      segment = self.journal.roll() if self.journal is not None else None
+      dirty, deleted, changes = self.dirty_users, self.deleted_users, self.changes
+      globals_dirty, globals_replaced = self.globals_dirty, self.globals_replaced
+      self.dirty_users, self.deleted_users, self.changes = set(), set(), {}
+      self.globals_dirty, self.globals_replaced = set(), False
+      cache = self.db["economy"].cache
+      ops, size, updates = [], 0, 0
+      for userid in dirty:
+        if userid not in cache:
+          continue
+        if userid in changes:
+          update = build_update(cache[userid], changes[userid])
+          size += self.storage.encoded_size(update)
+          ops.append(("update", userid, update))
+          updates += 1
+        else:
+          doc = plain(cache[userid])
+          size += self.storage.encoded_size(doc)
+          ops.append(("replace", userid, doc))
+      for userid in deleted:
+        ops.append(("delete", userid))
+      globals_doc, globals_keys, globals_writes = None, None, 0
+      others = self.dbo["others"]
+      if globals_replaced:
+        globals_doc = plain(others)
+        globals_writes = len(globals_doc)
+      elif globals_dirty:
+        globals_keys = list(globals_dirty)
+        globals_doc = {key: plain(others[key]) for key in globals_keys if key in others}
+        globals_writes = len(globals_keys)
+      if globals_doc is not None:
+        size += self.storage.encoded_size(globals_doc)
+      self.flushing, self.flushing_deleted = dirty, deleted
+      try:
+        await self.run(self._write, ops, globals_doc, globals_keys)
+      except Exception:
+        # Requeue everything (unless it was deleted/recreated in the meantime) so the next flush retries it.
+        # Part of the batch may have been applied, so users are rewritten whole rather than $inc'd twice
+        for userid in dirty:
+          if userid not in self.deleted_users:
+            self.dirty_users.add(userid)
+            self.changes.pop(userid, None)
+        for userid in deleted:
+          if userid not in self.dirty_users:
+            self.deleted_users.add(userid)
+        self.globals_dirty |= globals_dirty
+        self.globals_replaced = self.globals_replaced or globals_replaced
+        self.stats["failed_flushes"] += 1
+        raise
+      finally:
+        self.flushing, self.flushing_deleted = set(), set()
+      self.db["economy"].evict()
+      if segment is not None:
+        await self.journal.checkpoint(segment)
+      writes = len(ops) + globals_writes
+      duration = time.perf_counter() - start
+      self.stats["flushes"] += 1
+      self.stats["failed_flushes"] = 0
+      self.stats["writes"] += writes
+      self.stats["bytes_written"] += size
+      self.stats["field_updates"] += updates
+      self.stats["replaces"] += len(ops) - len(deleted) - updates
+      self.stats["last_flush"] = int(time.time())
+      self.stats["last_flush_duration"] = duration
+      self.stats["max_flush_duration"] = max(self.stats["max_flush_duration"], duration)
+      return writes
@@ -0,0 +1,81 @@
+import os
+import gzip
+import time
+from array import array
+
+# dump/income/<unix time of the first settlement>.tsv.gz, one per income tick:
+#   userid  hours  payout  cleanliness  boosts_expired
+# for every settlement made during that hour, written as it happens
+
+
+def percentile(values: list, p: float):
+  """
+  Nearest rank percentile of already sorted values
+  """
+  if not values:
+    return 0
+  return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+class IncomeReport:
+  """
+  Collects the settlements made between two income ticks: totals for the hourly embed,
+  and a line per user streamed into a gzipped file that is attached to it. The last keep files are kept on disk.
+  """
+  def __init__(self, directory: str="dump/income", keep: int=48):
+    self.directory = directory
+    self.keep = keep
+    self.file = None
+    self.path = None
+    os.makedirs(directory, exist_ok=True)
+    self._reset()
+
+  def _reset(self) -> None:
+    self.payouts = array("q")
+    self.hours = 0
+    self.expired = 0
+
+  def _open(self) -> None:
+    self.path = os.path.join(self.directory, f"{int(time.time())}.tsv.gz")
+    self.file = gzip.open(self.path, "wt", encoding="utf-8")
+    self.file.write("userid\thours\tpayout\tcleanliness\tboosts_expired\n")
+
+  def record(self, users: list, hours: int, payouts: list, cleanliness: list, expired: list) -> None:
+    if self.file is None:
+      self._open()
+    self.payouts.extend(payouts)
+    self.hours += hours * len(users)
+    self.expired += sum(expired)
+    self.file.write("".join(
+      f"{userid}\t{hours}\t{payout}\t{clean}\t{gone}\n"
+      for (userid, _), payout, clean, gone in zip(users, payouts, cleanliness, expired)
+    ))
+
+  def rotate(self):
+    """
+    Closes the current hour, returns (summary, path of its log or None if nobody was settled)
+    """
+    payouts = sorted(self.payouts)
+    summary = {
+      "users": len(payouts), "hours": self.hours, "minted": sum(payouts), "expired": self.expired,
+      "p50": percentile(payouts, 50), "p90": percentile(payouts, 90), "p99": percentile(payouts, 99),
+      "max": payouts[-1] if payouts else 0
+    }
+    path = None
+    if self.file is not None:
+      self.file.close()
+      path = self.path
+      self.file = None
+    self._reset()
+    self._prune()
+    return summary, path
+
+  def _prune(self) -> None:
+    logs = sorted((name for name in os.listdir(self.directory) if name.endswith(".tsv.gz")), key=lambda name: int(name.split(".")[0]))
+    for name in logs[:-self.keep]:
+      os.remove(os.path.join(self.directory, name))
+
+  def close(self) -> None:
+    if self.file is not None:
+      self.file.close()
+      self.file = None
@@ -0,0 +1,144 @@
+import os
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+MISSING = object()
+
+
+def lookup(root, path):
+  """
+  Follows a path of keys through nested dicts, returns MISSING if it does not exist
+  """
+  for key in path:
+    if not isinstance(root, dict) or key not in root:
+      return MISSING
+    root = root[key]
+  return root
+
+def apply_entry(users: dict, others: dict, entry: dict):
+  """
+  Applies one journal entry to plain user/globals dicts, returns the user id touched (None for globals)
+  """
+  path = entry["p"]
+  if entry["s"] == "u":
+    userid = entry["id"]
+    if not path:
+      if entry.get("x"):
+        users.pop(userid, None)
+      else:
+        users[userid] = entry["v"]
+      return userid
+    root = users.setdefault(userid, {})
+  else:
+    userid = None
+    if not path:
+      others.clear()
+      others.update(entry["v"])
+      return userid
+    root = others
+  for key in path[:-1]:
+    if not isinstance(root.get(key), dict):
+      root[key] = {}
+    root = root[key]
+  if entry.get("x"):
+    root.pop(path[-1], None)
+  else:
+    root[path[-1]] = entry["v"]
+  return userid
+
+
+class Journal:
+  """
+  Append-only local log of every economy mutation.
+  Entries are buffered in memory and fsynced in batches on a dedicated thread. The log is split into
+  numbered segments; a segment is deleted once a database flush that started after it has succeeded.
+  """
+  def __init__(self, directory: str="dump/journal"):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+    self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-io")
+    segments = self.segments()
+    self.segment = segments[-1] + 1 if segments else 1
+    self.buffer = []
+    self.pending = [] # [(segment, lines)] waiting to be written
+    self.stats = {"entries": 0, "syncs": 0, "bytes_written": 0}
+
+  def path(self, segment: int) -> str:
+    return os.path.join(self.directory, f"{segment:08}.log")
+
+  def segments(self) -> list:
+    return sorted(int(f[:-4]) for f in os.listdir(self.directory) if f.endswith(".log") and f[:-4].isdigit())
+
+  def record(self, scope: str, id_, path: tuple, value=MISSING) -> None:
+    """
+    scope is "u" (a user, id_ is their id) or "g" (the globals document)
+    """
+    entry = {"s": scope, "id": id_, "p": list(path)}
+    if value is MISSING:
+      entry["x"] = 1
+    else:
+      entry["v"] = value
+    self.buffer.append(json.dumps(entry, separators=(",", ":")))
+    self.stats["entries"] += 1
+
+  def roll(self) -> int:
+    """
+    Starts a new segment, returns the one that was just closed
+    """
+    if self.buffer:
+      self.pending.append((self.segment, self.buffer))
+      self.buffer = []
+    closed = self.segment
+    self.segment += 1
+    return closed
+
+  def _write(self, batches: list) -> int:
+    size = 0
+    for segment, lines in batches:
+      data = "\n".join(lines) + "\n"
+      with open(self.path(segment), "a", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+      size += len(data)
+    return size
+
+  def _remove(self, upto: int) -> None:
+    for segment in self.segments():
+      if segment <= upto:
+        os.remove(self.path(segment))
+
+  async def sync(self) -> None:
+    """
+    Writes and fsyncs everything recorded so far
+    """
+    if self.buffer:
+      self.pending.append((self.segment, self.buffer))
+      self.buffer = []
+    if not self.pending:
+      return
+    batches, self.pending = self.pending, []
+    loop = asyncio.get_running_loop()
+    self.stats["bytes_written"] += await loop.run_in_executor(self.executor, self._write, batches)
+    self.stats["syncs"] += 1
+
+  async def checkpoint(self, upto: int) -> None:
+    """
+    Drops every segment up to (and including) upto, their changes are safely in the database
+    """
+    await self.sync()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(self.executor, self._remove, upto)
+
+  def read(self):
+    """
+    Yields every entry still on disk, oldest first. A torn last line (crash mid-write) is skipped.
+    """
+    for segment in self.segments():
+      with open(self.path(segment), encoding="utf-8") as f:
+        for line in f:
+          try:
+            yield json.loads(line)
+          except ValueError:
+            continue
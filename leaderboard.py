@@ -0,0 +1,202 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+
+def rankable(value) -> bool:
+  return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class RankIndex:
+  """
+  Every user's value of one (dotted) field, highest first (ties broken by user id), kept in order as values change.
+  The (-value, userid) keys are split into sorted buckets of at most 2*load keys, so a change only shifts one bucket around,
+  the top k is read straight off the buckets and a rank is two bisects plus adding up the sizes of the buckets before it.
+  """
+  def __init__(self, field: str, values: dict=None, load: int=500, members: set=None):
+    self.field = field
+    self.path = tuple(field.split("."))
+    self.load = load
+    self.members = members # only these users are ranked (None: everyone)
+    self.values = {} # userid: value
+    self.total = 0 # sum of the values
+    self.buckets = [] # sorted lists of (-value, userid)
+    self.maxes = [] # last key of each bucket
+    if values:
+      self.values = {userid: value for userid, value in values.items() if rankable(value) and (members is None or userid in members)}
+      self.total = sum(self.values.values())
+      keys = sorted((-value, userid) for userid, value in self.values.items())
+      self.buckets = [keys[i:i+load] for i in range(0, len(keys), load)]
+      self.maxes = [bucket[-1] for bucket in self.buckets]
+
+  def __len__(self) -> int:
+    return len(self.values)
+
+  def __contains__(self, userid) -> bool:
+    return userid in self.values
+
+  def set(self, userid: str, value) -> None:
+    """
+    Moves a user to their new value (anything that is not a number takes them off the index)
+    """
+    if not rankable(value) or (self.members is not None and userid not in self.members):
+      self.discard(userid)
+      return
+    old = self.values.get(userid)
+    if old == value and old is not None:
+      return
+    if old is not None:
+      self._remove((-old, userid))
+      self.total -= old
+    self.values[userid] = value
+    self.total += value
+    self._add((-value, userid))
+
+  def discard(self, userid: str) -> None:
+    old = self.values.pop(userid, None)
+    if old is not None:
+      self._remove((-old, userid))
+      self.total -= old
+
+  def _add(self, key: tuple) -> None:
+    if not self.buckets:
+      self.buckets.append([key])
+      self.maxes.append(key)
+      return
+    i = min(bisect_left(self.maxes, key), len(self.maxes) - 1)
+    bucket = self.buckets[i]
+    insort(bucket, key)
+    self.maxes[i] = bucket[-1]
+    if len(bucket) > 2 * self.load:
+      self.buckets[i:i+1] = [bucket[:self.load], bucket[self.load:]]
+      self.maxes[i:i+1] = [bucket[self.load - 1], bucket[-1]]
+
+  def _remove(self, key: tuple) -> None:
+    i = bisect_left(self.maxes, key)
+    bucket = self.buckets[i]
+    del bucket[bisect_left(bucket, key)]
+    if bucket:
+      self.maxes[i] = bucket[-1]
+    else:
+      del self.buckets[i]
+      del self.maxes[i]
+
+  def top(self, k: int, offset: int=0) -> list:
+    """
+    [(userid, value)] of the k users ranked after the first offset
+    """
+    results = []
+    for bucket in self.buckets:
+      if offset >= len(bucket):
+        offset -= len(bucket)
+        continue
+      for value, userid in bucket[offset:offset + k - len(results)]:
+        results.append((userid, -value))
+      offset = 0
+      if len(results) >= k:
+        break
+    return results
+
+  def rank(self, userid: str):
+    """
+    1 based rank of a user, None if they are not on the index
+    """
+    value = self.values.get(userid)
+    if value is None:
+      return None
+    key = (-value, userid)
+    i = bisect_left(self.maxes, key)
+    return sum(len(bucket) for bucket in self.buckets[:i]) + bisect_left(self.buckets[i], key) + 1
+
+
+class ScopedIndexes:
+  """
+  RankIndexes of a subset of users (a guild's members) cut out of a field's full index the first time they are asked for,
+  then kept in step with it. Only the max_scopes most recently used are kept. Every user's scope keys are kept too,
+  so a change only touches the scopes its user is in.
+  """
+  def __init__(self, max_scopes: int=100):
+    self.max_scopes = max_scopes
+    self.scopes = OrderedDict() # (field, scope key): RankIndex, least recently used first
+    self.fields = {} # field: {scope key: RankIndex}
+    self.members = {} # scope key: set of user ids (shared by the scope's RankIndexes)
+    self.memberships = {} # userid: set of the scope keys they are in
+
+  def get(self, index: RankIndex, key, members) -> RankIndex:
+    """
+    The index of field scoped to key, members is the set of user ids in it (or a function returning it, only called to build the index)
+    """
+    scoped = self.scopes.get((index.field, key))
+    if scoped is not None:
+      self.scopes.move_to_end((index.field, key))
+      return scoped
+    if key not in self.members:
+      self.members[key] = set(members() if callable(members) else members)
+      for userid in self.members[key]:
+        self.memberships.setdefault(userid, set()).add(key)
+    members = self.members[key]
+    scoped = RankIndex(index.field, {userid: index.values[userid] for userid in members if userid in index.values}, index.load, members)
+    self.scopes[(index.field, key)] = scoped
+    self.fields.setdefault(index.field, {})[key] = scoped
+    while len(self.scopes) > self.max_scopes:
+      self._forget(*next(iter(self.scopes)))
+    return scoped
+
+  def _forget(self, field: str, key) -> None:
+    del self.scopes[(field, key)]
+    del self.fields[field][key]
+    if not self.fields[field]:
+      del self.fields[field]
+    if any(key in scopes for scopes in self.fields.values()):
+      return
+    for userid in self.members.pop(key):
+      keys = self.memberships[userid]
+      keys.discard(key)
+      if not keys:
+        del self.memberships[userid]
+
+  def set(self, field: str, userid: str, value) -> None:
+    scopes = self.fields.get(field)
+    if not scopes:
+      return
+    for key in self.memberships.get(userid, ()):
+      scoped = scopes.get(key)
+      if scoped is not None:
+        scoped.set(userid, value)
+
+  def discard(self, userid: str) -> None:
+    for key in self.memberships.get(userid, ()):
+      for scopes in self.fields.values():
+        if key in scopes:
+          scopes[key].discard(userid)
+
+  def drop(self, field: str) -> None:
+    """
+    Forgets the scopes of a field, for when its full index is rebuilt
+    """
+    for key in list(self.fields.get(field, ())):
+      self._forget(field, key)
+
+  def joined(self, key, userid: str, indexes: dict) -> None:
+    """
+    Adds a member to every scope under key, with their values from the full indexes ({field: RankIndex})
+    """
+    if key not in self.members:
+      return
+    self.members[key].add(userid)
+    self.memberships.setdefault(userid, set()).add(key)
+    for field, scopes in self.fields.items():
+      if key in scopes and field in indexes:
+        scopes[key].set(userid, indexes[field].values.get(userid))
+
+  def left(self, key, userid: str) -> None:
+    if key not in self.members:
+      return
+    self.members[key].discard(userid)
+    keys = self.memberships.get(userid)
+    if keys is not None:
+      keys.discard(key)
+      if not keys:
+        del self.memberships[userid]
+    for scopes in self.fields.values():
+      if key in scopes:
+        scopes[key].discard(userid)
@@ -6,10 +6,17 @@ import math
 import jishaku
 from vars import *
 from errors import *
-from datetime import date
-import pymongo
-import dns
-from pymongo import MongoClient
+from database import Database
+from storage import create_storage
+from journal import Journal
+from backup import Backups
+from migrations import Migrator
+from settlement import Accrual
+from monitor import LoopMonitor
+from income_log import IncomeReport
+from batch import BatchPool
+from scheduler import Scheduler
+from telemetry import Telemetry
 from typing import Optional
 import discord
 from discord import app_commands
@@ -34,33 +41,74 @@ stop_bot = os.environ["STOP_BOT"]
 class MyBot(commands.Bot):
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
+    self.index_loaders = [] # background index loads started by setup_hook
+
+  async def setup_hook(self):
+    # Kept here, the loop only holds weak references to tasks
+    self.index_loaders = [
+      asyncio.create_task(bot.database.load_index()),
+      asyncio.create_task(bot.database.load_indexes(leaderboard_fields))
+    ]
+    for task in self.index_loaders:
+      task.add_done_callback(self.index_loaded)
+    bot.loop_monitor.start()
+    self.flusher.start()
+    self.journal_sync.start()
+
+  def index_loaded(self, task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+      print(f"Loading an index failed, reads fall back to the database: {task.exception()!r}")
+
+  async def close(self):
+    for task in self.index_loaders:
+      task.cancel()
+    self.flusher.cancel()
+    self.journal_sync.cancel()
+    bot.loop_monitor.stop()
+    bot.scheduler.stop()
+    bot.income_report.close()
+    bot.batch_pool.close()
+    await bot.database.journal.sync()
+    await self.save_db(force=True)
+    await super().close()
 
   async def interaction_check(self, itx: discord.Interaction) -> bool:
     return False
 
   # Functions 
-  async def save_db(self):
+  async def save_db(self, force: bool=False):
+    """
+    Changes are written behind by the flusher, this only writes straight away when forced or when too many records are waiting
+    """
+    if not force and bot.database.queue_depth < db_flush_threshold:
+      return
     try:
-      collection.replace_one({"_id" : 63}, {"_id" : 63, "economy" : bot.db["economy"]})
-      collection.replace_one({"_id" : 64}, {"_id" : 64, "others" : bot.dbo["others"]})
+      await bot.database.flush()
     except Exception as e:
+      # Changes are safe in the local journal, keep serving and retry on the next flush
+      print(f"Failed to flush db ({bot.database.stats['failed_flushes']} in a row): {e}")
       log_channel = bot.get_channel(1030104234278014976)
-      #print(bot.db, bot.dbo)
-      embed = discord.Embed(title="DB Error", description=f"{e}")
-      await log_channel.send(embed=embed)
-      exec(stop_bot)
+      if bot.database.stats["failed_flushes"] == 1 and log_channel is not None:
+        embed = discord.Embed(title="DB Error", description=f"{e} \nChanges are kept in the local journal until the db is reachable again.")
+        await log_channel.send(embed=embed)
+
+  @tasks.loop(seconds=db_flush_interval)
+  async def flusher(self):
+    await self.save_db(force=True)
+
+  @tasks.loop(seconds=journal_sync_interval)
+  async def journal_sync(self):
+    await bot.database.journal.sync()
 
-  async def create_backup(self, type_: str="db"):
+  async def create_backup(self, full: bool=False):
+    """
+    Writes the next compressed backup (a full snapshot or the users changed since the last one) and uploads it
+    Restore with `python backup.py`
+    """
     db_channel = bot.get_channel(926098991953870930)
-    today = date.today()
-    timestamp = today.strftime("%d %B %Y, %A")
-    data = bot.db["economy"]
-    data2 = bot.dbo["others"]
-    with open("dump/backup.txt", "w") as backup:
-      backup.truncate(0)
-      backup.write("Economy: \n" + str(data) + "\nOthers: \n" + str(data2) + f"\n[{int(time.time())}]")
-    await db_channel.send(file=discord.File("dump/backup.txt"))
-    os.remove("dump/backup.txt")
+    path = await bot.backups.create(full)
+    if db_channel is not None:
+      await db_channel.send(file=discord.File(path))
 
   async def itx_check(self, itx: discord.Interaction, msg: str=None, failed: bool = True):
     if failed:
@@ -184,12 +232,7 @@ class MyBot(commands.Bot):
     level = bot.db["economy"][str(user)]["levels"]["level"]
     xp = bot.db["economy"][str(user)]["levels"]["xp"]
     xp_mult = bot.db["economy"][str(user)]["levels"]["xp_mult"]
-    personal_mult = 0
-    boosts = bot.db["economy"][str(user)]["boosts"]
-    type_ = "xp"
-    for boost in range(len(boosts[type_])): # boost = {mult: duration}
-      for k in boosts[type_][boost]:
-        personal_mult += float(k)
+    personal_mult = bot.db["economy"][str(user)]["boost_mult"]["xp"]
     total_mult = round(amt * (xp_mult + personal_mult))
     updated_xp = round(xp + total_mult) # + guild mult
     #await bot.guild_xp(ctx, round(amt * (xp_mult + guild_mult)))
@@ -224,30 +267,6 @@ class MyBot(commands.Bot):
       bot.db["economy"][str(user)]["levels"]["xp"] = updated_xp
       return f"\nXp Earned: **{total_mult} 🔹** `{updated_xp} / {xp_needed}`"
 
-  async def get_income(self, userid):
-    """
-    Gets user's income based on upgrades and boosters
-    """
-    userid = str(userid)
-    income = bot.db["economy"][userid]["income"]
-    income_boost = bot.db["economy"][userid]["income_boost"]
-    if bot.dbo["others"]["global_income_boost"] != {}:
-      global_boost = float(list(bot.dbo["others"]["global_income_boost"].keys())[0])
-    else:
-      global_boost = 0
-    personal_mult = 0
-    boosts = bot.db["economy"][userid]["boosts"]
-    type_ = "income"
-    for user in bot.db["economy"]:
-      for boost in range(len(boosts[type_])): # boost = {mult: duration}
-        for k in boosts[type_][boost]:
-          personal_mult += float(k)
-    total_boosts = income_boost + global_boost + personal_mult
-    if total_boosts == 0:
-      total_boosts = 1
-    income = income*total_boosts
-    return income, (income_boost, global_boost, personal_mult)
-
   async def log_action(self, type: str, action: str) -> None:
     """
     Logs actions to a discord channel
@@ -283,8 +302,6 @@ class MyBot(commands.Bot):
             num -= val[i]
         i += 1
     return roman_num
-    
-  #async def setup_hook(self):
 
 
 class MyTree(app_commands.CommandTree):
@@ -292,6 +309,10 @@ class MyTree(app_commands.CommandTree):
     """
     Checks for blacklisted users, maintenance mode and alerts
     """
+    # Fetch everyone this command is about in one go, so the (sync) checks and commands hit the cache
+    await itx.client.database.prefetch(
+      [itx.user.id] + [value.id for _, value in itx.namespace if isinstance(value, (discord.User, discord.Member))]
+    )
     blacklist = itx.client.dbo["others"]["user_blacklist"]
     if str(itx.user.id) in blacklist:
       if int(time.time()) < blacklist[str(itx.user.id)]["time"]:
@@ -326,14 +347,17 @@ Dm me `.info` to join the support server!"""
     return True
 
       
+telemetry = Telemetry()
 bot = MyBot(
   command_prefix = commands.when_mentioned_or("."), 
   intents=intents, 
   case_insensitive = True, 
   activity = activity,
   strip_after_prefix = True,
-  tree_cls = MyTree
+  tree_cls = MyTree,
+  http_trace = telemetry.trace_config()
 )
+bot.telemetry = telemetry
 bot.remove_command("help")
 bot.db, bot.dbo = {}, {}
 bot.cache = {
@@ -346,22 +370,20 @@ bot.giving_income = False
 
 
 
-# MC Connection
-mcs = os.getenv("mcs")
-cluster = pymongo.MongoClient(mcs)
-database = cluster["CocoaBot"]
-collection = database["db"]
-results = collection.find({"_id" : 63})
-#create a conection to mongodb cluster 
-try:
-  for result in results:
-    bot.db = result
-  results = collection.find({"_id" : 64})
-  for result in results:
-    bot.dbo = result
-except:
-  print("Could not connect to db, stopping code...")
-  exec(stop_bot)
+# Batch workers are forked before anything starts a thread: MongoClient starts its monitors as soon as it is built
+bot.batch_pool = BatchPool(batch_workers, batch_min_rows)
+if __name__ == "__main__":
+  bot.batch_pool.start()
+
+# DB Connection (DB_BACKEND picks mongo, sqlite or memory)
+bot.database = Database(create_storage(), Journal("dump/journal"), user_cache_size)
+bot.migrator = Migrator(bot.database)
+bot.backups = Backups(bot.database, "dump/backups", backup_full_every, backup_keep_chains)
+bot.loop_monitor = LoopMonitor()
+bot.income_report = IncomeReport("dump/income", income_log_keep)
+bot.accrual = Accrual(bot.database, settlement_slice_budget, bot.loop_monitor, bot.income_report, bot.batch_pool)
+bot.database.accrue = bot.accrual.accrue
+bot.scheduler = Scheduler(bot.database)
 
 
 @bot.after_invoke
@@ -371,6 +393,16 @@ async def after_invoke(ctx):
 
 async def main():
   async with bot:
+    #create a conection to mongodb cluster 
+    try:
+      await bot.database.migrate_legacy()
+      bot.db, bot.dbo = await bot.database.load()
+      bot.accrual.start()
+      bot.dbo["others"].setdefault("legacy_shop_reset", bot.dbo["others"]["last_shop_reset"])
+    except Exception:
+      print("Could not connect to db, stopping code...")
+      exec(stop_bot)
+    await bot.save_db(force=True) # writes back anything replayed from the journal
     for file in os.listdir("./cogs"):
       if file.endswith(".py"):
         try:
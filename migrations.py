@@ -0,0 +1,174 @@
+import time
+import asyncio
+from records import compact
+from settlement import HOUR, personal_mult
+
+# Every user record carries the schema version it is at in record["schema"] (missing = 0).
+# Migrations run in order on anything older, lazily when a record is loaded or in batches with `dev migrate`.
+# They have to be idempotent and must never assume a key exists: a record can be half way through
+# a migration when the bot stops, and very old records can be missing anything.
+# Every migration gets the record and the globals (others), which it must only read.
+MIGRATIONS = [] # [(version, description, func)]
+
+
+def migration(version: int, description: str):
+  def decorator(func):
+    if MIGRATIONS and version <= MIGRATIONS[-1][0]:
+      raise ValueError(f"Migration {version} is out of order")
+    MIGRATIONS.append((version, description, func))
+    return func
+  return decorator
+
+
+class MigrationError(Exception):
+  pass
+
+
+@migration(1, "Replace chests with diamonds")
+def _chests(record, others):
+  record.pop("chests", None)
+  record.setdefault("diamonds", 0)
+
+@migration(2, "Add fishing")
+def _fish(record, others):
+  fish = record.setdefault("fish", {})
+  for key, value in {"last_fish": 0, "rod_level": 1, "tuna": 0, "grouper": 0, "snapper": 0, "salmon": 0, "cod": 0}.items():
+    fish.setdefault(key, value)
+
+@migration(3, "Add pet food")
+def _pets(record, others):
+  pets = record.setdefault("pets", {"name": "", "type": "", "tier": 0, "level": 0, "last_hunt": 1, "last_feed": 1, "last_play": 1})
+  pets.setdefault("food", 0)
+
+@migration(4, "Add games")
+def _games(record, others):
+  games = record.setdefault("games", {})
+  games.setdefault("sliding_puzzle_8_moves", -1)
+  games.setdefault("sliding_puzzle_8_time", -1)
+
+@migration(5, "Add votes")
+def _votes(record, others):
+  vote = record.setdefault("vote", {})
+  for key, value in {"last_vote": 1, "count": 0, "streak": 0}.items():
+    vote.setdefault(key, value)
+
+@migration(6, "Add recipes")
+def _recipes(record, others):
+  fragments = record.setdefault("recipes", {}).setdefault("fragments", {})
+  for key, value in {"normal": 20, "dark": 0, "milk": 0, "almond": 0, "white": 0, "caramel": 0, "peanut butter": 0, "strawberry": 0}.items():
+    fragments.setdefault(key, value)
+
+@migration(7, "Add daily quests")
+def _quests(record, others):
+  if not isinstance(record.get("quest"), dict) or not all(q in record["quest"] for q in ("fish", "hunt", "income")):
+    record["quest"] = {
+      "fish": {"name": "tuna", "times": 5, "completed": False},
+      "hunt": {"times": 1, "times_completed": 0, "completed": False},
+      "income": {"times": 1, "times_completed": 0, "completed": False}
+    }
+    record["last_quest"] = 1
+
+@migration(8, "Remove per user global boosts")
+def _global_boosts(record, others):
+  boosts = record.get("boosts")
+  if isinstance(boosts, dict):
+    boosts.pop("global", None)
+
+@migration(9, "Move upgrade names and max levels to the catalog")
+def _upgrade_catalog(record, others):
+  compact(record)
+
+@migration(10, "Boosts expire at an income tick instead of counting hours down")
+def _boost_expiry(record, others):
+  # Hours left were counted from the tick the record was settled up to
+  since = record.setdefault("settled", others.get("lazy_since", others["last_income"]))
+  boosts = record.setdefault("boosts", {})
+  mults = {}
+  for type_ in ("income", "xp"):
+    kept = []
+    for boost in boosts.get(type_, []):
+      for k, v in boost.items():
+        expires = v if v > since else since + v*HOUR # already converted
+        if expires > since:
+          kept.append({k: expires})
+    boosts[type_] = kept
+    mults[type_] = personal_mult(kept)
+  record["boost_mult"] = mults
+
+@migration(11, "Stamp shop purchases with the shop reset they were made after")
+def _shop_generation(record, others):
+  bought = record.get("bought_from_shop")
+  if not isinstance(bought, dict):
+    # Lists were emptied at every reset, so they hold what was bought since the last reset before stamping
+    record["bought_from_shop"] = {"reset": others.get("legacy_shop_reset", others["last_shop_reset"]), "items": list(bought or [])}
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def upgrade_record(record: dict, others: dict) -> bool:
+  """
+  Brings a record up to SCHEMA_VERSION in place, returns whether anything ran.
+  Raises MigrationError if a migration fails, the record is left at the last version that succeeded.
+  """
+  version = record.get("schema", 0)
+  if version >= SCHEMA_VERSION:
+    return False
+  for number, description, func in MIGRATIONS:
+    if number <= version:
+      continue
+    try:
+      func(record, others)
+    except Exception as e:
+      raise MigrationError(f"Migration {number} ({description}) failed: {e!r}") from e
+    record["schema"] = number
+  return True
+
+
+class Migrator:
+  """
+  Runs the pending migrations over every outdated user in batches, yielding to the event loop between them.
+  Progress lives in the records themselves (their schema version), so a run that was interrupted just resumes.
+  """
+  def __init__(self, database, batch: int=500):
+    self.database = database
+    self.batch = batch
+    self.running = False
+    self.progress = {"done": 0, "total": 0, "migrated": 0, "failed": 0, "started": 0, "dry_run": False}
+
+  async def pending(self) -> list:
+    return list(await self.database.run(self.database.storage.ids_below, "schema", SCHEMA_VERSION))
+
+  async def run(self, dry_run: bool=False, on_progress=None) -> dict:
+    """
+    on_progress(progress) is awaited after every batch. A dry run only reads: it migrates copies and counts what would change.
+    """
+    if self.running:
+      raise RuntimeError("A migration is already running")
+    self.running = True
+    database = self.database
+    try:
+      userids = await self.pending()
+      self.progress = {"done": 0, "total": len(userids), "migrated": 0, "failed": 0, "started": int(time.time()), "dry_run": dry_run}
+      for i in range(0, len(userids), self.batch):
+        chunk = userids[i:i+self.batch]
+        if dry_run:
+          users = await database.run(database.storage.get_users, chunk)
+          for record in users.values():
+            try:
+              self.progress["migrated"] += upgrade_record(record, database.dbo["others"])
+            except MigrationError:
+              self.progress["failed"] += 1
+        else:
+          # Records are migrated as they are loaded into the cache, flushing straight away keeps them from piling up there
+          migrated, failed = database.stats["migrated"], database.stats["failed_migrations"]
+          await database.prefetch(chunk)
+          await database.flush()
+          self.progress["migrated"] += database.stats["migrated"] - migrated
+          self.progress["failed"] += database.stats["failed_migrations"] - failed
+        self.progress["done"] += len(chunk)
+        if on_progress is not None:
+          await on_progress(self.progress)
+        await asyncio.sleep(0)
+      return self.progress
+    finally:
+      self.running = False
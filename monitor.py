@@ -0,0 +1,47 @@
+import time
+import asyncio
+from contextlib import contextmanager
+
+
+class LoopMonitor:
+  """
+  Measures event loop stalls: a task sleeps for interval over and over, anything it wakes up late by
+  is time something else held the loop (and every command and button waiting behind it)
+  """
+  def __init__(self, interval: float=0.05):
+    self.interval = interval
+    self.task = None
+    self.windows = [] # stats of the measure() blocks that are open
+    self.stats = {"max_stall": 0.0, "last_stall": 0.0, "samples": 0}
+
+  def start(self) -> None:
+    if self.task is None or self.task.done():
+      self.task = asyncio.create_task(self._run())
+
+  def stop(self) -> None:
+    if self.task is not None:
+      self.task.cancel()
+      self.task = None
+
+  async def _run(self) -> None:
+    while True:
+      start = time.perf_counter()
+      await asyncio.sleep(self.interval)
+      stall = max(time.perf_counter() - start - self.interval, 0.0)
+      self.stats["last_stall"] = stall
+      self.stats["max_stall"] = max(self.stats["max_stall"], stall)
+      self.stats["samples"] += 1
+      for window in self.windows:
+        window["max_stall"] = max(window["max_stall"], stall)
+
+  @contextmanager
+  def measure(self):
+    """
+    with monitor.measure() as window: ... window["max_stall"] is the longest stall seen while the block ran
+    """
+    window = {"max_stall": 0.0}
+    self.windows.append(window)
+    try:
+      yield window
+    finally:
+      self.windows.remove(window)
@@ -0,0 +1,68 @@
+import sys
+import json
+from vars import upgrade_catalog
+
+
+def compact(record: dict) -> dict:
+  """
+  Drops the static upgrade fields (name, max) that are already in upgrade_catalog from a user record, in place
+  """
+  upgrades = record.get("upgrades")
+  if not isinstance(upgrades, dict):
+    return record
+  for location, entries in upgrades.items():
+    catalog = upgrade_catalog.get(location)
+    if catalog is None or not isinstance(entries, dict):
+      continue
+    for name, entry in entries.items():
+      static = catalog.get(name)
+      if static is None or not isinstance(entry, dict):
+        continue
+      for field, value in static.items():
+        if entry.get(field) == value:
+          del entry[field]
+  return record
+
+def expand(record: dict) -> dict:
+  """
+  The record as it was stored before compact(), with the catalog fields written out for every upgrade
+  """
+  record = json.loads(json.dumps(record))
+  for location, entries in record.get("upgrades", {}).items():
+    for name, entry in entries.items():
+      entry.update({**upgrade_catalog.get(location, {}).get(name, {}), **entry})
+  return record
+
+
+def deep_size(value, seen: set) -> int:
+  """
+  Bytes used by a value and everything inside it, objects already in seen (shared between records) are not counted again
+  """
+  if id(value) in seen:
+    return 0
+  seen.add(id(value))
+  size = sys.getsizeof(value)
+  path = getattr(value, "_path", None) # tracked dicts and lists
+  if path is not None:
+    size += deep_size(path, seen)
+  if isinstance(value, dict):
+    for k, v in value.items():
+      size += deep_size(k, seen) + deep_size(v, seen)
+  elif isinstance(value, (list, tuple)):
+    for v in value:
+      size += deep_size(v, seen)
+  return size
+
+def memory_report(records: list) -> dict:
+  """
+  Average bytes per user for the given (cached) records, against the same records in the old layout:
+  catalog fields stored in every record and nothing interned (every record decoded on its own)
+  """
+  if not records:
+    return {"users": 0, "before": 0, "after": 0}
+  seen = set()
+  after = sum(deep_size(record, seen) for record in records)
+  expanded = [expand(record) for record in records] # kept alive so ids in seen are not reused
+  seen = set()
+  before = sum(deep_size(record, seen) for record in expanded)
+  return {"users": len(records), "before": before // len(records), "after": after // len(records)}
@@ -0,0 +1,115 @@
+import time
+import asyncio
+import traceback
+
+
+class Scheduler:
+  """
+  Runs jobs at absolute unix times: one task sleeps until the earliest deadline (or until a job is rescheduled) and runs what is due.
+  A job is an async function returning when it should run next (None to wait until it is rescheduled).
+  Deadlines are kept in others["schedule"], so after a restart every job picks up where it left off and anything missed runs at once.
+  Jobs added with persist=False (frequent ones with nothing to catch up on) keep theirs in memory and start over after a restart.
+  """
+  def __init__(self, database, retry: int=60, max_sleep: int=300):
+    self.database = database
+    self.retry = retry # seconds before a job that raised runs again
+    self.max_sleep = max_sleep # sleeps are monotonic, waking up now and then follows changes to the wall clock
+    self.jobs = {} # name: job function
+    self.transient = {} # name: deadline of the jobs that are not persisted
+    self.stats = {} # name: {"runs", "failures", "last_run", "last_duration", "max_duration", "last_lag", "max_lag"}
+    self.task = None
+    self.wake = asyncio.Event()
+
+  @property
+  def schedule(self):
+    return self.database.dbo["others"].setdefault("schedule", {})
+
+  def add(self, name: str, job, deadline=None, persist: bool=True) -> None:
+    """
+    Registers (or replaces) a job. deadline is used if the schedule has nothing for it yet
+    """
+    self.jobs[name] = job
+    self.stats.setdefault(name, {"runs": 0, "failures": 0, "last_run": 0, "last_duration": 0.0, "max_duration": 0.0, "last_lag": 0.0, "max_lag": 0.0})
+    if not persist:
+      self.schedule.pop(name, None)
+      self.transient.setdefault(name, deadline)
+      self.wake.set()
+    elif name not in self.schedule:
+      self.transient.pop(name, None)
+      self.reschedule(name, deadline)
+
+  def deadline(self, name: str):
+    """
+    When a job runs next (0 if the schedule has nothing for it)
+    """
+    if name in self.transient:
+      return self.transient[name]
+    return self.schedule.get(name, 0)
+
+  def reschedule(self, name: str, deadline) -> None:
+    """
+    Sets when a job runs next (None: not until it is rescheduled again)
+    """
+    if name in self.transient:
+      self.transient[name] = deadline
+    else:
+      schedule = self.schedule
+      if name not in schedule or schedule[name] != deadline:
+        schedule[name] = deadline
+    self.wake.set()
+
+  def next_run(self):
+    """
+    (name, deadline) of the job due first, or None if nothing is scheduled.
+    A job missing from the schedule (the globals were reset) is due now and works out its next run itself
+    """
+    due = [(self.deadline(name), name) for name in self.jobs if self.deadline(name) is not None]
+    if not due:
+      return None
+    deadline, name = min(due)
+    return name, deadline
+
+  def start(self) -> None:
+    if self.task is None or self.task.done():
+      self.task = asyncio.create_task(self._run())
+
+  def stop(self) -> None:
+    if self.task is not None:
+      self.task.cancel()
+      self.task = None
+
+  async def _run(self) -> None:
+    while True:
+      self.wake.clear()
+      due = self.next_run()
+      delay = self.max_sleep if due is None else min(due[1] - time.time(), self.max_sleep)
+      if delay > 0:
+        try:
+          await asyncio.wait_for(self.wake.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+          pass
+        continue
+      await self.run_job(*due)
+
+  async def run_job(self, name: str, deadline=None):
+    """
+    Runs a job now and schedules its next run
+    """
+    stats = self.stats[name]
+    start = time.time()
+    lag = max(start - deadline, 0.0) if deadline is not None else 0.0
+    try:
+      deadline = await self.jobs[name]()
+    except Exception:
+      print(f"Scheduled job {name} failed, retrying in {self.retry}s")
+      traceback.print_exc()
+      stats["failures"] += 1
+      deadline = int(time.time()) + self.retry
+    took = time.time() - start
+    stats["runs"] += 1
+    stats["last_run"] = int(start)
+    stats["last_duration"] = took
+    stats["max_duration"] = max(stats["max_duration"], took)
+    stats["last_lag"] = lag
+    stats["max_lag"] = max(stats["max_lag"], lag)
+    self.reschedule(name, deadline)
@@ -0,0 +1,478 @@
+import gc
+import math
+import time
+import asyncio
+from contextlib import nullcontext
+try:
+  import numpy as np
+except ImportError: # falls back to plain Python, with the same results
+  np = None
+
+HOUR = 3600
+CLEANLINESS_DECAY = 0.5 # per hour
+
+
+def personal_mult(boosts: list) -> float:
+  """
+  Sum of the multipliers of a user's [{mult: expiry tick}] boosts
+  """
+  return sum(float(k) for boost in boosts for k in boost)
+
+def total_mult(income_boost: float, global_boost: float, personal: float) -> float:
+  total = income_boost + global_boost + personal
+  return total if total != 0 else 1
+
+
+def flatten_boosts(boost_lists: list) -> tuple:
+  """
+  ([owner index], [mult key], [value]) for every boost in a list of [{mult: value}] lists
+  """
+  owners, keys, values = [], [], []
+  for i in [i for i, boosts in enumerate(boost_lists) if boosts]:
+    for boost in boost_lists[i]:
+      for k, v in boost.items():
+        owners.append(i)
+        keys.append(k)
+        values.append(v)
+  return owners, keys, values
+
+
+# Payouts are rounded to whole coins, what was rounded away is kept in record["income_carry"] and added to the next payout,
+# so a user ends up with the same balance whether they are settled every hour or once for a whole day.
+
+def _compute_numpy(income, income_boost, personal, cleanliness, carry, global_boost: float):
+  income = np.asarray(income, dtype=np.float64)
+  total = np.asarray(income_boost, dtype=np.float64) + global_boost + np.asarray(personal, dtype=np.float64)
+  total[total == 0] = 1
+  cleanliness = np.asarray(cleanliness, dtype=np.float64)
+  owed = income * total / 100 * cleanliness + np.asarray(carry, dtype=np.float64)
+  payouts = np.rint(owed)
+  decayed = cleanliness - CLEANLINESS_DECAY
+  decayed[decayed < 0] = 0
+  return payouts.astype(np.int64).tolist(), decayed.tolist(), (owed - payouts).tolist()
+
+def _compute_python(income, income_boost, personal, cleanliness, carry, global_boost: float):
+  payouts, decayed, carried = [], [], []
+  for i in range(len(income)):
+    owed = income[i] * total_mult(income_boost[i], global_boost, personal[i]) / 100 * cleanliness[i] + carry[i]
+    payouts.append(round(owed))
+    decayed.append(max(cleanliness[i] - CLEANLINESS_DECAY, 0))
+    carried.append(owed - payouts[-1])
+  return payouts, decayed, carried
+
+def compute(income: list, income_boost: list, personal: list, cleanliness: list, carry: list, global_boost: float):
+  """
+  One hour of income for every user at once: returns (payouts, cleanliness after decay, carry)
+  """
+  if np is not None:
+    return _compute_numpy(income, income_boost, personal, cleanliness, carry, global_boost)
+  return _compute_python(income, income_boost, personal, cleanliness, carry, global_boost)
+
+
+# Catching up on k hours in one step:
+# hour h (0 to k-1) pays income/100 * total_h * c_h, where c_h = max(c - 0.5h, 0) and total_h is the sum of the boosts
+# running at hour h (1 if that is 0). A boost running for hours a to b-1 adds mult * (cleanliness summed over a to b-1),
+# and the hours where nothing runs add their cleanliness. Cleanliness summed over the first n hours is an arithmetic series,
+# so nothing loops over the hours and the cost does not depend on k.
+# Personal boosts with v hours left run for hours 0 to v-1, global boosts for the (start, end) hours they are given.
+
+def _clean_sum_numpy(cleanliness, hours):
+  n = np.maximum(np.minimum(hours, np.ceil(cleanliness / CLEANLINESS_DECAY)), 0)
+  return n * cleanliness - CLEANLINESS_DECAY / 2 * n * (n - 1)
+
+def clean_sum(cleanliness: float, hours: int) -> float:
+  """
+  Cleanliness summed over the next hours, as it decays by CLEANLINESS_DECAY an hour down to 0
+  """
+  n = float(max(min(hours, math.ceil(cleanliness / CLEANLINESS_DECAY)), 0))
+  return n * cleanliness - CLEANLINESS_DECAY / 2 * n * (n - 1)
+
+def _catch_up_numpy(income, income_boost, cleanliness, carry, boosts, global_boosts: list, hours: int):
+  owners, mults, left = boosts
+  income = np.asarray(income, dtype=np.float64)
+  income_boost = np.asarray(income_boost, dtype=np.float64)
+  cleanliness = np.asarray(cleanliness, dtype=np.float64)
+  full = _clean_sum_numpy(cleanliness, hours)
+  boosted = income_boost * full
+  for mult, start, end in global_boosts:
+    boosted += mult * (_clean_sum_numpy(cleanliness, min(end, hours)) - _clean_sum_numpy(cleanliness, min(start, hours)))
+  personal_end = np.zeros(len(income))
+  if owners:
+    owners = np.asarray(owners)
+    ends = np.minimum(np.asarray(left, dtype=np.float64), hours)
+    boosted += np.bincount(owners, np.asarray(mults) * _clean_sum_numpy(cleanliness[owners], ends), len(income))
+    np.maximum.at(personal_end, owners, ends)
+  idle = full - _clean_sum_numpy(cleanliness, personal_end)
+  for mult, start, end in global_boosts:
+    if mult:
+      start, end = np.maximum(personal_end, min(start, hours)), np.maximum(personal_end, min(end, hours))
+      idle -= _clean_sum_numpy(cleanliness, end) - _clean_sum_numpy(cleanliness, start)
+  boosted += np.where(income_boost == 0, idle, 0)
+  owed = income / 100 * boosted + np.asarray(carry, dtype=np.float64)
+  payouts = np.rint(owed)
+  decayed = cleanliness - CLEANLINESS_DECAY * hours
+  decayed[decayed < 0] = 0
+  return payouts.astype(np.int64).tolist(), decayed.tolist(), (owed - payouts).tolist()
+
+def _catch_up_python(income, income_boost, cleanliness, carry, boosts, global_boosts: list, hours: int):
+  owners, mults, left = boosts
+  personal = [0.0] * len(income)
+  personal_end = [0] * len(income)
+  for i, mult, ends in zip(owners, mults, left):
+    ends = min(ends, hours)
+    personal[i] += mult * clean_sum(cleanliness[i], ends)
+    personal_end[i] = max(personal_end[i], ends)
+  payouts, decayed, carried = [], [], []
+  for i in range(len(income)):
+    c = cleanliness[i]
+    full = clean_sum(c, hours)
+    boosted = income_boost[i] * full
+    for mult, start, end in global_boosts:
+      boosted += mult * (clean_sum(c, min(end, hours)) - clean_sum(c, min(start, hours)))
+    boosted += personal[i]
+    idle = full - clean_sum(c, personal_end[i])
+    for mult, start, end in global_boosts:
+      if mult:
+        idle -= clean_sum(c, max(personal_end[i], min(end, hours))) - clean_sum(c, max(personal_end[i], min(start, hours)))
+    boosted += idle if income_boost[i] == 0 else 0
+    owed = income[i] / 100 * boosted + carry[i]
+    payouts.append(round(owed))
+    decayed.append(max(c - CLEANLINESS_DECAY * hours, 0))
+    carried.append(owed - payouts[-1])
+  return payouts, decayed, carried
+
+def catch_up(income: list, income_boost: list, cleanliness: list, carry: list, boosts: tuple, global_boosts: list, hours: int):
+  """
+  Several hours of income for every user at once: returns (payouts, cleanliness after decay, carry).
+  boosts are the flattened (owners, mults, hours_left) personal boosts, global_boosts [(mult, start hour, end hour)] don't overlap.
+  """
+  if np is not None:
+    return _catch_up_numpy(income, income_boost, cleanliness, carry, boosts, global_boosts, hours)
+  return _catch_up_python(income, income_boost, cleanliness, carry, boosts, global_boosts, hours)
+
+
+def expire_boosts(boosts: tuple, tick: int) -> dict:
+  """
+  Finds the flattened boosts (owners, keys, expiry ticks) that have expired by tick,
+  returns {index: (boosts left, sum of the expired mults)} for the owners that had any
+  """
+  owners, keys, expires = boosts
+  if not expires:
+    return {}
+  if np is not None:
+    expired = (np.asarray(expires) <= tick).tolist()
+  else:
+    expired = [e <= tick for e in expires]
+  result = {}
+  for i, gone in zip(owners, expired):
+    if gone:
+      result[i] = ([], 0.0)
+  for i, k, e, gone in zip(owners, keys, expires, expired):
+    if i in result:
+      kept, mult = result[i]
+      if gone:
+        result[i] = (kept, mult + float(k))
+      else:
+        kept.append({k: e})
+  return result
+
+def shift_boosts(boosts: tuple, by: int, tick: int) -> dict:
+  """
+  Moves the expiry of flattened boosts by seconds, returns {index: (boosts left at tick, their summed mult)} for every owner
+  """
+  owners, keys, expires = boosts
+  result = {}
+  for i, k, e in zip(owners, keys, expires):
+    kept, mult = result.setdefault(i, ([], 0.0))
+    if e + by > tick:
+      kept.append({k: e + by})
+      result[i] = (kept, mult + float(k))
+  return result
+
+def add_boost(record, type_: str, mult: str, hours: int, tick: int) -> None:
+  """
+  Gives a user a personal boost that runs for the next hours of income (counting from the income tick they are settled up to)
+  """
+  record["boosts"][type_].append({mult: tick + hours*HOUR})
+  record["boost_mult"][type_] += float(mult)
+
+
+def settleable(record) -> bool:
+  """
+  Whether a record has every field extract() and apply_settlement() read (a record whose migration failed may not)
+  """
+  try:
+    record["income"], record["income_boost"], record["cleanliness"], record["boosts"]["income"], record["boosts"]["xp"]
+    record["boost_mult"]["income"], record["boost_mult"]["xp"]
+  except (KeyError, TypeError):
+    return False
+  return True
+
+def extract(records: list) -> dict:
+  """
+  The columns settlement reads from each record, as plain values that can be sent to a worker process
+  """
+  return {
+    "income": [record["income"] for record in records],
+    "income_boost": [record["income_boost"] for record in records],
+    "cleanliness": [record["cleanliness"] for record in records],
+    "carry": [record.get("income_carry", 0) for record in records],
+    "personal": [record["boost_mult"]["income"] for record in records],
+    "income_boosts": flatten_boosts([record["boosts"]["income"] for record in records]),
+    "xp_boosts": flatten_boosts([record["boosts"]["xp"] for record in records])
+  }
+
+def compute_settlement(columns: dict, global_boosts: list, hours: int, since: int) -> dict:
+  """
+  Works out a settlement from extract() columns without touching any record, returns
+  {"payouts", "cleanliness", "carry": columns, "expired": {type: expire_boosts() result}}
+  """
+  if hours == 1:
+    global_boost = sum(mult for mult, start, end in global_boosts if start <= 0 < end)
+    payouts, decayed, carried = compute(columns["income"], columns["income_boost"], columns["personal"], columns["cleanliness"], columns["carry"], global_boost)
+  else:
+    owners, keys, expires = columns["income_boosts"]
+    left = [(e - since) // HOUR for e in expires]
+    payouts, decayed, carried = catch_up(columns["income"], columns["income_boost"], columns["cleanliness"], columns["carry"], (owners, [float(k) for k in keys], left), global_boosts, hours)
+  tick = since + hours*HOUR
+  return {
+    "payouts": payouts, "cleanliness": decayed, "carry": carried,
+    "expired": {type_: expire_boosts(columns[f"{type_}_boosts"], tick) for type_ in ("income", "xp")}
+  }
+
+def apply_settlement(records: list, columns: dict, result: dict, skip: set=frozenset()) -> list:
+  """
+  Writes a compute_settlement() result back to the records it was extracted from, leaving out the indexes in skip.
+  Returns how many boosts each record lost
+  """
+  # Only touch what changed so idle users with nothing left to decay are not rewritten
+  for i, (record, payout, before, after, was, left) in enumerate(zip(records, result["payouts"], columns["cleanliness"], result["cleanliness"], columns["carry"], result["carry"])):
+    if i in skip:
+      continue
+    if payout:
+      record["balance"] += payout
+    if after != before:
+      record["cleanliness"] = after
+    if left != was:
+      record["income_carry"] = left
+  expired_boosts = [0] * len(records)
+  for type_, expired in result["expired"].items():
+    for i, (boosts, mult) in expired.items():
+      if i in skip:
+        continue
+      record = records[i]
+      expired_boosts[i] += len(record["boosts"][type_]) - len(boosts)
+      record["boosts"][type_] = boosts
+      record["boost_mult"][type_] = record["boost_mult"][type_] - mult if boosts else 0
+  return expired_boosts
+
+def settle(users: list, global_boosts: list, hours: int=1, since: int=0) -> list:
+  """
+  Pays hours of income from the income tick since to a batch of [(userid, record)], decays their cleanliness and drops their expired boosts.
+  global_boosts are the [(mult, start hour, end hour)] global boosts that ran during those hours.
+  Boosts are {mult: expiry tick}, every boost a record holds is running at since and record["boost_mult"] is their sum.
+  Returns the columns (payouts, income_boosts, personal_mults, cleanliness, boosts expired), in the order of users
+  """
+  records = [record for _, record in users]
+  columns = extract(records)
+  result = compute_settlement(columns, global_boosts, hours, since)
+  expired_boosts = apply_settlement(records, columns, result)
+  return result["payouts"], columns["income_boost"], columns["personal"], result["cleanliness"], expired_boosts
+
+
+class Accrual:
+  """
+  Nothing pays every user every hour: each record remembers the income tick it was settled up to (record["settled"])
+  and is brought up to date (income, cleanliness, boosts) whenever it is prefetched, which every command, vote and
+  leaderboard does before reading it. The hourly job only moves others["last_income"] on.
+  Boosts expire at an income tick, so nothing counts them down: a user's expired boosts are dropped when they are settled,
+  and every global boost is logged in others["global_boost_history"] as [mult, start, end] so late settlements know when it ran.
+  """
+  def __init__(self, database, slice_budget: float=0.025, monitor=None, report=None, pool=None):
+    self.database = database
+    self.pool = pool # BatchPool sweeps compute their settlements in
+    self.slice_budget = slice_budget # seconds a sweep may hold the event loop for between yields
+    self.monitor = monitor # LoopMonitor, for the stalls seen during sweeps
+    self.report = report # IncomeReport every settlement is logged to
+    self.unsettleable = set() # users left unsettled because their record is missing fields
+    self.stats = {
+      "settled": 0, "hours": 0, "unsettleable": 0,
+      "slices": 0, "last_slice": 0.0, "max_slice": 0.0,
+      "last_sweep": 0, "last_sweep_duration": 0.0, "sweep_slices": 0, "sweep_max_slice": 0.0, "sweep_max_stall": 0.0
+    }
+
+  @property
+  def others(self):
+    return self.database.dbo["others"]
+
+  def start(self) -> None:
+    """
+    Records settled before accrual existed were paid up to the last income tick.
+    A global boost from before boosts expired at a tick still holds the hours it had left
+    """
+    others = self.others
+    others.setdefault("lazy_since", others["last_income"])
+    if others["global_income_boost"]:
+      key, expires = next(iter(others["global_income_boost"].items()))
+      if expires < 10**9: # hours, not a unix time
+        self.add_global_boost(key, expires)
+      elif expires <= others["last_income"]:
+        others["global_income_boost"] = {}
+
+  def settled(self, record) -> int:
+    return record.get("settled", self.others["lazy_since"])
+
+  def global_boosts(self, since: int, until: int) -> list:
+    """
+    The global boosts that ran between two income ticks, as [(mult, start hour, end hour)] counted from since
+    """
+    boosts = []
+    for key, start, end in self.others.get("global_boost_history", []):
+      start, end = max(start, since), min(end, until)
+      if start < end:
+        boosts.append((float(key), (start - since) // HOUR, (end - since) // HOUR))
+    return boosts
+
+  def _groups(self, users: list, tick: int) -> dict:
+    """
+    {settled tick: [(userid, record)]} of the users that are an hour or more behind tick.
+    Records settlement cannot read are left out (and reported once), so they do not fail everyone else's settlement
+    """
+    groups = {}
+    for userid, record in users:
+      since = self.settled(record)
+      if tick - since >= HOUR:
+        if not settleable(record):
+          if userid not in self.unsettleable:
+            self.unsettleable.add(userid)
+            self.stats["unsettleable"] = len(self.unsettleable)
+            print(f"Could not settle {userid}, their record is missing fields")
+          continue
+        groups.setdefault(since, []).append((userid, record))
+    return groups
+
+  def _settled(self, group: list, since: int, hours: int, payouts: list, cleanliness: list, expired: list) -> None:
+    for _, record in group:
+      record["settled"] = since + hours * HOUR
+    if self.report is not None:
+      self.report.record(group, hours, payouts, cleanliness, expired)
+    self.stats["settled"] += len(group)
+    self.stats["hours"] += len(group) * hours
+
+  def _slice(self, took: float) -> None:
+    self.stats["slices"] += 1
+    self.stats["last_slice"] = took
+    self.stats["max_slice"] = max(self.stats["max_slice"], took)
+
+  def accrue(self, users: list) -> None:
+    """
+    Brings [(userid, record)] up to the last income tick, users settled up to the same tick are settled together
+    """
+    start = time.perf_counter()
+    tick = self.others["last_income"]
+    for since, group in self._groups(users, tick).items():
+      hours = (tick - since) // HOUR
+      payouts, _, _, cleanliness, expired = settle(group, self.global_boosts(since, tick), hours, since)
+      self._settled(group, since, hours, payouts, cleanliness, expired)
+    self._slice(time.perf_counter() - start)
+
+  async def accrue_batch(self, users: list) -> None:
+    """
+    accrue() for a large batch: only the columns are read and the result written on the event loop, the pool does the rest.
+    Anyone settled by accrue() in the meantime (a command prefetched them) is left alone
+    """
+    took = 0.0
+    tick = self.others["last_income"]
+    for since, group in self._groups(users, tick).items():
+      start = time.perf_counter()
+      hours = (tick - since) // HOUR
+      records = [record for _, record in group]
+      columns = extract(records)
+      took += time.perf_counter() - start
+      result = await self.pool.run(compute_settlement, len(records), columns, self.global_boosts(since, tick), hours, since)
+      start = time.perf_counter()
+      cache = self.database.db["economy"].cache
+      skip = {i for i, (userid, record) in enumerate(group) if self.settled(record) != since or cache.get(userid, record) is not record}
+      expired = apply_settlement(records, columns, result, skip)
+      kept = [i for i in range(len(records)) if i not in skip]
+      if skip:
+        group = [group[i] for i in kept]
+      self._settled(group, since, hours, [result["payouts"][i] for i in kept], [result["cleanliness"][i] for i in kept], [expired[i] for i in kept])
+      took += time.perf_counter() - start
+    self._slice(took)
+
+  def add_global_boost(self, mult: str, hours: int) -> None:
+    """
+    Starts a global boost for the next hours of income, replacing the one running (history windows must not overlap)
+    """
+    others = self.others
+    start = others["last_income"]
+    history = others.setdefault("global_boost_history", [])
+    for window in [window for window in history if window[2] > start]:
+      if window[1] >= start:
+        history.remove(window)
+      else:
+        window[2] = start # it ran up to now
+    others["global_income_boost"] = {mult: start + hours*HOUR}
+    history.append([mult, start, start + hours*HOUR])
+
+  def advance(self, hours: int) -> None:
+    """
+    Moves the income clock on by hours, ending the global boost if it expired
+    """
+    others = self.others
+    others["last_income"] += hours * HOUR
+    boost = others["global_income_boost"]
+    if boost and next(iter(boost.values())) <= others["last_income"]:
+      others["global_income_boost"] = {}
+
+  async def sweep(self, batch: int=100) -> int:
+    """
+    Settles every user (prefetching does it, or accrue_batch() with a pool) and drops the global boost history that no record needs any more.
+    Keeps balances in the database (and leaderboards) at most a sweep behind for users who never run a command.
+    Users go in slices resized to hold the event loop for about slice_budget in all each, with a yield to the event loop after every slice.
+    """
+    database = self.database
+    if database.db["economy"].known is None:
+      await database.load_index()
+    table = database.db["economy"]
+    userids = list(table.known)
+    tick = self.others["last_income"]
+    start = time.perf_counter()
+    slices = 0
+    max_slice = 0.0
+    # Full garbage collections walk every cached record and were the longest stalls during a sweep,
+    # freezing what is already alive keeps them out of those collections until the sweep is done
+    gc.freeze()
+    try:
+      with self.monitor.measure() if self.monitor is not None else nullcontext({"max_stall": 0.0}) as window:
+        i = 0
+        while i < len(userids):
+          chunk = userids[i:i+batch]
+          i += len(chunk)
+          slices += 1
+          # CPU time of this (the event loop's) thread: everything the slice did on the loop, fetching and wrapping
+          # the records, settling them and building their writes, but not the waits for the I/O thread or the pool
+          cpu = time.thread_time()
+          if self.pool is not None:
+            await database.prefetch(chunk, accrue=False)
+            await self.accrue_batch([(userid, table.cache[userid]) for userid in chunk if userid in table.cache])
+          else:
+            await database.prefetch(chunk)
+          await database.flush() # settled records stay pinned in the cache until they are written
+          took = time.thread_time() - cpu
+          max_slice = max(max_slice, took)
+          batch = int(min(max(batch * self.slice_budget / max(took, 1e-4), 10), batch * 2, 5000))
+          await asyncio.sleep(0)
+    finally:
+      gc.unfreeze()
+    history = self.others.get("global_boost_history", [])
+    kept = [entry for entry in history if entry[2] > tick]
+    if len(kept) != len(history):
+      self.others["global_boost_history"] = kept
+    self.stats["last_sweep"] = int(time.time())
+    self.stats["last_sweep_duration"] = time.perf_counter() - start
+    self.stats["sweep_slices"] = slices
+    self.stats["sweep_max_slice"] = max_slice
+    self.stats["sweep_max_stall"] = window["max_stall"]
+    return len(userids)
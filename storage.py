@@ -0,0 +1,423 @@
+import os
+import time
+import copy
+import json
+import sqlite3
+from typing import Optional
+
+# Legacy layout: the whole economy lived in {"_id": 63, "economy": {...}}
+# and everything else in {"_id": 64, "others": {...}}
+LEGACY_ECONOMY_ID = 63
+LEGACY_OTHERS_ID = 64
+GLOBALS_ID = "others"
+
+
+def default_globals() -> dict:
+  """
+  A fresh globals document
+  """
+  return {
+    "alert_msg": "Hello there! \nUse `/help` for help!!",
+    "read_alert": [], # list of user IDs
+    "alert_ping": False,
+    "lottery": {
+      "cost": 1,
+      "msgid": None,
+      "end": 1,
+      "entrants": [], # ids of the users who reacted
+    },
+    "total_commands_ran": 1057,
+    "global_income_boost": {}, # {mult: expiry income tick}
+    "global_xp_boost": 0, # XP BOOST NOT IMPLEMENTED
+    "maintenancemode": False,
+    "shop_items": {},
+    "last_shop_reset": 1669564800,
+    "legacy_shop_reset": 1669564800, # the reset unstamped bought_from_shop lists are from
+    "user_blacklist": {},
+    "server_blacklists": {},
+    "last_income": int(time.time()) - (int(time.time()%3600)), # makes it the nearest hour
+    "lazy_since": int(time.time()) - (int(time.time()%3600)), # users without a "settled" tick were paid up to here
+    "global_boost_history": [], # [[mult, start, end]] income ticks the global boost ran for
+    "schedule": {}, # {job: unix time it runs next}, see scheduler.py
+    "error_count": 1,
+    "code": {}
+  }
+
+
+class Storage:
+  """
+  Where user records and the globals live. Every method is blocking and is only
+  ever called from the database I/O thread.
+  Each top level key of the globals is stored on its own, so a flush only rewrites the keys that
+  changed and no single key has to share a document size limit with the rest.
+
+  Writes are a list of operations:
+  ("replace", userid, doc), ("update", userid, {"$set"/"$inc"/"$unset": {dotted.path: value}}) and ("delete", userid)
+  Updates are only sent for users that already exist
+  """
+  name = "storage"
+
+  def get_globals(self) -> Optional[dict]:
+    raise NotImplementedError
+
+  def put_globals(self, doc: dict, keys: Optional[list]=None) -> None:
+    """
+    Writes the given top level keys (missing from doc = deleted), or replaces everything when keys is None
+    """
+    raise NotImplementedError
+
+  def get_users(self, userids: list) -> dict:
+    raise NotImplementedError
+
+  def user_ids(self) -> set:
+    raise NotImplementedError
+
+  def count_users(self) -> int:
+    return len(self.user_ids())
+
+  def write(self, ops: list) -> None:
+    raise NotImplementedError
+
+  def ids_below(self, field: str, value) -> set:
+    """
+    Ids of the users whose (dotted) field is missing or lower than value
+    """
+    raise NotImplementedError
+
+  def top(self, field: str, k: int, exclude: list) -> list:
+    """
+    [(userid, value)] of the k highest values of a (dotted) field, ignoring the excluded users
+    """
+    raise NotImplementedError
+
+  def total(self, field: str, exclude: list):
+    raise NotImplementedError
+
+  def values(self, field: str) -> dict:
+    """
+    {userid: value} of a (dotted) field for every user that has it
+    """
+    raise NotImplementedError
+
+  def migrate_legacy(self) -> bool:
+    return False
+
+  def encoded_size(self, doc: dict) -> int:
+    return len(json.dumps(doc, separators=(",", ":")))
+
+
+def get_field(doc: dict, field: str):
+  for key in field.split("."):
+    if not isinstance(doc, dict) or key not in doc:
+      return None
+    doc = doc[key]
+  return doc
+
+
+def apply_update(doc: dict, update: dict) -> None:
+  """
+  Applies a $set/$inc/$unset update to a plain document, the way MongoDB would
+  """
+  for op, fields in update.items():
+    for field, value in fields.items():
+      *parents, key = field.split(".")
+      parent = doc
+      for name in parents:
+        if op == "$unset" and not isinstance(parent.get(name), dict):
+          parent = None
+          break
+        parent = parent.setdefault(name, {})
+      if parent is None:
+        continue
+      if op == "$set":
+        parent[key] = copy.deepcopy(value)
+      elif op == "$inc":
+        parent[key] = parent.get(key, 0) + value
+      elif op == "$unset":
+        parent.pop(key, None)
+      else:
+        raise ValueError(f"Unsupported update operator: {op}")
+
+
+class MemoryStorage(Storage):
+  """
+  Keeps everything in process, for tests and benchmarks
+  """
+  name = "memory"
+
+  def __init__(self, users: Optional[dict]=None, others: Optional[dict]=None):
+    self.users = copy.deepcopy(users or {})
+    self.others = copy.deepcopy(others)
+
+  def get_globals(self):
+    if self.others is None:
+      self.others = default_globals()
+    return copy.deepcopy(self.others)
+
+  def put_globals(self, doc, keys=None):
+    if keys is None or self.others is None:
+      self.others = {}
+      keys = list(doc)
+    for key in keys:
+      if key in doc:
+        self.others[key] = copy.deepcopy(doc[key])
+      else:
+        self.others.pop(key, None)
+
+  def get_users(self, userids):
+    return {u: copy.deepcopy(self.users[u]) for u in userids if u in self.users}
+
+  def user_ids(self):
+    return set(self.users)
+
+  def write(self, ops):
+    for op in ops:
+      if op[0] == "delete":
+        self.users.pop(op[1], None)
+      elif op[0] == "update":
+        if op[1] in self.users:
+          apply_update(self.users[op[1]], op[2])
+      else:
+        self.users[op[1]] = copy.deepcopy(op[2])
+
+  def ids_below(self, field, value):
+    return {u for u, d in self.users.items() if get_field(d, field) is None or get_field(d, field) < value}
+
+  def top(self, field, k, exclude):
+    exclude = set(exclude)
+    values = [(u, get_field(d, field)) for u, d in self.users.items() if u not in exclude]
+    values = [v for v in values if v[1] is not None]
+    values.sort(key=lambda v: v[1], reverse=True)
+    return values[:k]
+
+  def total(self, field, exclude):
+    exclude = set(exclude)
+    return sum(get_field(d, field) or 0 for u, d in self.users.items() if u not in exclude)
+
+  def values(self, field):
+    values = {u: get_field(d, field) for u, d in self.users.items()}
+    return {u: v for u, v in values.items() if v is not None}
+
+
+class SQLiteStorage(Storage):
+  """
+  One row of JSON per user in a local SQLite file, so the bot can run (and be benchmarked) without MongoDB
+  """
+  name = "sqlite"
+
+  def __init__(self, path: str="dump/cocoabot.sqlite3"):
+    self.path = path
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, doc TEXT NOT NULL)")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS globals (id TEXT PRIMARY KEY, doc TEXT NOT NULL)")
+    self.conn.commit()
+
+  def get_globals(self):
+    rows = self.conn.execute("SELECT id, doc FROM globals WHERE id LIKE ?", (f"{GLOBALS_ID}.%",)).fetchall()
+    if rows:
+      return {id_[len(GLOBALS_ID)+1:]: json.loads(doc) for id_, doc in rows}
+    row = self.conn.execute("SELECT doc FROM globals WHERE id = ?", (GLOBALS_ID,)).fetchone()
+    doc = json.loads(row[0]) if row is not None else default_globals() # single row layout, split it up
+    self.put_globals(doc)
+    return doc
+
+  def put_globals(self, doc, keys=None):
+    with self.conn:
+      if keys is None:
+        self.conn.execute("DELETE FROM globals WHERE id = ? OR id LIKE ?", (GLOBALS_ID, f"{GLOBALS_ID}.%"))
+        keys = list(doc)
+      for key in keys:
+        if key in doc:
+          self.conn.execute("REPLACE INTO globals (id, doc) VALUES (?, ?)", (f"{GLOBALS_ID}.{key}", json.dumps(doc[key])))
+        else:
+          self.conn.execute("DELETE FROM globals WHERE id = ?", (f"{GLOBALS_ID}.{key}",))
+
+  def get_users(self, userids):
+    users = {}
+    for i in range(0, len(userids), 500):
+      chunk = userids[i:i+500]
+      rows = self.conn.execute(f"SELECT id, doc FROM users WHERE id IN ({','.join('?'*len(chunk))})", chunk)
+      for userid, doc in rows:
+        users[userid] = json.loads(doc)
+    return users
+
+  def user_ids(self):
+    return {row[0] for row in self.conn.execute("SELECT id FROM users")}
+
+  def count_users(self):
+    return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+  def write(self, ops):
+    with self.conn:
+      for op in ops:
+        if op[0] == "delete":
+          self.conn.execute("DELETE FROM users WHERE id = ?", (op[1],))
+        elif op[0] == "update":
+          row = self.conn.execute("SELECT doc FROM users WHERE id = ?", (op[1],)).fetchone()
+          if row is not None:
+            doc = json.loads(row[0])
+            apply_update(doc, op[2])
+            self.conn.execute("UPDATE users SET doc = ? WHERE id = ?", (json.dumps(doc), op[1]))
+        else:
+          self.conn.execute("REPLACE INTO users (id, doc) VALUES (?, ?)", (op[1], json.dumps(op[2])))
+
+  def ids_below(self, field, value):
+    path = f"$.{field}"
+    rows = self.conn.execute("SELECT id FROM users WHERE json_extract(doc, ?) IS NULL OR json_extract(doc, ?) < ?", (path, path, value))
+    return {row[0] for row in rows}
+
+  def _excluding(self, exclude: list):
+    self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS excluded (id TEXT PRIMARY KEY)")
+    self.conn.execute("DELETE FROM excluded")
+    self.conn.executemany("INSERT OR IGNORE INTO excluded (id) VALUES (?)", [(u,) for u in exclude])
+
+  def top(self, field, k, exclude):
+    self._excluding(exclude)
+    rows = self.conn.execute(
+      "SELECT id, json_extract(doc, ?) AS value FROM users WHERE id NOT IN (SELECT id FROM excluded) "
+      "AND value IS NOT NULL ORDER BY value DESC LIMIT ?", (f"$.{field}", k)
+    )
+    return [(userid, value) for userid, value in rows]
+
+  def total(self, field, exclude):
+    self._excluding(exclude)
+    row = self.conn.execute(
+      "SELECT SUM(json_extract(doc, ?)) FROM users WHERE id NOT IN (SELECT id FROM excluded)", (f"$.{field}",)
+    ).fetchone()
+    return row[0] or 0
+
+  def values(self, field):
+    rows = self.conn.execute("SELECT id, json_extract(doc, ?) AS value FROM users WHERE value IS NOT NULL", (f"$.{field}",))
+    return {userid: value for userid, value in rows}
+
+
+class MongoStorage(Storage):
+  """
+  One document per user in the users collection. In the db collection, every top level key of the
+  globals is its own {"_id": "others.<key>", "v": value} document, listed by the {"_id": "others", "keys": [...]} document
+  """
+  name = "mongo"
+
+  def __init__(self, uri: str, database: str="CocoaBot"):
+    import dns # needed for mongodb+srv:// uris
+    from pymongo import MongoClient, ReplaceOne, UpdateOne, DeleteOne
+    import bson
+    self.ReplaceOne, self.UpdateOne, self.DeleteOne, self.bson = ReplaceOne, UpdateOne, DeleteOne, bson
+    self.cluster = MongoClient(uri)
+    self.users = self.cluster[database]["users"]
+    self.globals = self.cluster[database]["db"]
+    self.keys = None # keys listed in the index document
+
+  def get_globals(self):
+    index = self.globals.find_one({"_id": GLOBALS_ID})
+    if index is None:
+      return None
+    if "keys" not in index or len(index) > 2:
+      # Everything still in one document, split it up. The index document is written last,
+      # so this simply runs again if it is interrupted
+      index.pop("_id")
+      self.put_globals(index)
+      return index
+    ids = {f"{GLOBALS_ID}.{key}": key for key in index["keys"]}
+    self.keys = set(index["keys"])
+    return {ids[doc["_id"]]: doc["v"] for doc in self.globals.find({"_id": {"$in": list(ids)}})}
+
+  def put_globals(self, doc, keys=None):
+    full = keys is None
+    keys = list(doc) if full else keys
+    requests = []
+    for key in keys:
+      if key in doc:
+        requests.append(self.ReplaceOne({"_id": f"{GLOBALS_ID}.{key}"}, {"_id": f"{GLOBALS_ID}.{key}", "v": doc[key]}, upsert=True))
+      else:
+        requests.append(self.DeleteOne({"_id": f"{GLOBALS_ID}.{key}"}))
+    if full:
+      for key in (self.keys or set()) - set(doc):
+        requests.append(self.DeleteOne({"_id": f"{GLOBALS_ID}.{key}"}))
+    if requests:
+      self.globals.bulk_write(requests, ordered=False)
+    keys = set(doc) if full else ((self.keys or set()) | {k for k in keys if k in doc}) - {k for k in keys if k not in doc}
+    if keys != self.keys:
+      self.globals.replace_one({"_id": GLOBALS_ID}, {"_id": GLOBALS_ID, "keys": sorted(keys)}, upsert=True)
+      self.keys = keys
+
+  def get_users(self, userids):
+    users = {}
+    for doc in self.users.find({"_id": {"$in": userids}}):
+      users[doc.pop("_id")] = doc
+    return users
+
+  def user_ids(self):
+    return {doc["_id"] for doc in self.users.find({}, {"_id": 1})}
+
+  def count_users(self):
+    return self.users.estimated_document_count()
+
+  def requests(self, ops: list) -> list:
+    requests = []
+    for op in ops:
+      if op[0] == "delete":
+        requests.append(self.DeleteOne({"_id": op[1]}))
+      elif op[0] == "update":
+        requests.append(self.UpdateOne({"_id": op[1]}, op[2]))
+      else:
+        requests.append(self.ReplaceOne({"_id": op[1]}, {**op[2], "_id": op[1]}, upsert=True))
+    return requests
+
+  def write(self, ops):
+    if ops:
+      self.users.bulk_write(self.requests(ops), ordered=False)
+
+  def ids_below(self, field, value):
+    return {doc["_id"] for doc in self.users.find({"$or": [{field: {"$lt": value}}, {field: {"$exists": False}}]}, {"_id": 1})}
+
+  def top(self, field, k, exclude):
+    cursor = self.users.find({"_id": {"$nin": exclude}, field: {"$exists": True}}, {field: 1}).sort(field, -1).limit(k)
+    return [(doc["_id"], get_field(doc, field)) for doc in cursor]
+
+  def total(self, field, exclude):
+    result = list(self.users.aggregate([
+      {"$match": {"_id": {"$nin": exclude}}},
+      {"$group": {"_id": None, "total": {"$sum": f"${field}"}}}
+    ]))
+    return result[0]["total"] if result else 0
+
+  def values(self, field):
+    return {doc["_id"]: get_field(doc, field) for doc in self.users.find({field: {"$exists": True}}, {field: 1})}
+
+  def migrate_legacy(self):
+    """
+    One-shot migration from the legacy 63/64 documents. The globals document is written last,
+    so an interrupted migration simply runs again on the next start.
+    Legacy documents are left untouched as a backup.
+    """
+    if self.globals.find_one({"_id": GLOBALS_ID}, {"_id": 1}) is not None:
+      return False
+    legacy = self.globals.find_one({"_id": LEGACY_ECONOMY_ID})
+    others = self.globals.find_one({"_id": LEGACY_OTHERS_ID})
+    if legacy is None or others is None:
+      return False
+    ops = [("replace", userid, record) for userid, record in legacy["economy"].items()]
+    for i in range(0, len(ops), 1000):
+      self.write(ops[i:i+1000])
+    self.put_globals(others["others"])
+    print(f"Migrated {len(ops)} users from the legacy database layout")
+    return True
+
+  def encoded_size(self, doc):
+    return len(self.bson.encode(doc))
+
+
+def create_storage(backend: Optional[str]=None) -> Storage:
+  """
+  Picks the storage backend from the DB_BACKEND env var (mongo, sqlite or memory)
+  """
+  backend = backend or os.getenv("DB_BACKEND", "mongo")
+  if backend == "mongo":
+    return MongoStorage(os.getenv("mcs"))
+  if backend == "sqlite":
+    return SQLiteStorage(os.getenv("DB_PATH", "dump/cocoabot.sqlite3"))
+  if backend == "memory":
+    return MemoryStorage()
+  raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,105 @@
+import re
+import math
+import time
+from collections import deque
+from types import SimpleNamespace
+import aiohttp
+
+RETRY_AFTER_BUCKETS = (1, 5, 30, 60) # seconds, 429s are counted by the first bucket their retry_after fits under
+
+_ID = re.compile(r"/\d{15,21}(?=/|$)")
+_TOKEN = re.compile(r"/(webhooks|interactions)/\{id\}/[^/]+")
+_EMOJI = re.compile(r"/reactions/[^/]+")
+
+
+def route_key(method: str, path: str) -> str:
+  """
+  "GET /channels/{id}/messages/{id}": ids, tokens and emojis are left out so every call to a route shares one key
+  """
+  path = re.sub(r"^/api/v\d+", "", path)
+  path = _ID.sub("/{id}", path)
+  path = _TOKEN.sub(r"/\1/{id}/{token}", path)
+  path = _EMOJI.sub("/reactions/{emoji}", path)
+  return f"{method} {path}"
+
+def retry_after_bucket(retry_after: float) -> str:
+  for limit in RETRY_AFTER_BUCKETS:
+    if retry_after < limit:
+      return f"<{limit}s"
+  return f">={RETRY_AFTER_BUCKETS[-1]}s"
+
+
+class Telemetry:
+  """
+  Watches the bot's traffic with Discord without adding to it: every REST request discord.py makes is timed
+  through an aiohttp trace (per route counts, latency, 429s and how long they asked us to wait),
+  and the gateway heartbeat latency is sampled from the client. Nothing is sent anywhere, see the dev telemetry command.
+  """
+  def __init__(self, keep: int=120):
+    self.started = int(time.time())
+    self.routes = {} # route_key: {"requests", "errors", "rate_limited", "total_latency", "max_latency"}
+    self.retry_after = {} # retry_after_bucket: 429s
+    self.rate_limits = deque(maxlen=20) # (unix time, route, retry_after, scope) of the latest 429s
+    self.heartbeats = deque(maxlen=keep) # latest gateway latencies (seconds)
+
+  def trace_config(self) -> aiohttp.TraceConfig:
+    """
+    Pass as http_trace to the client
+    """
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(self._start)
+    trace.on_request_end.append(self._end)
+    trace.on_request_exception.append(self._exception)
+    return trace
+
+  async def _start(self, session, ctx: SimpleNamespace, params) -> None:
+    ctx.start = time.perf_counter()
+
+  async def _end(self, session, ctx: SimpleNamespace, params) -> None:
+    self.record(params.method, params.url.path, params.response.status, time.perf_counter() - ctx.start, params.response.headers)
+
+  async def _exception(self, session, ctx: SimpleNamespace, params) -> None:
+    self.record(params.method, params.url.path, 0, time.perf_counter() - ctx.start, {})
+
+  def record(self, method: str, path: str, status: int, latency: float, headers) -> None:
+    if not path.startswith("/api/"):
+      return # the gateway websocket goes through the same session
+    key = route_key(method, path)
+    route = self.routes.get(key)
+    if route is None:
+      route = self.routes[key] = {"requests": 0, "errors": 0, "rate_limited": 0, "total_latency": 0.0, "max_latency": 0.0}
+    route["requests"] += 1
+    route["total_latency"] += latency
+    route["max_latency"] = max(route["max_latency"], latency)
+    if status == 429:
+      route["rate_limited"] += 1
+      retry_after = float(headers.get("Retry-After", 0) or 0)
+      bucket = retry_after_bucket(retry_after)
+      self.retry_after[bucket] = self.retry_after.get(bucket, 0) + 1
+      scope = "global" if headers.get("X-RateLimit-Global") else headers.get("X-RateLimit-Scope", "user")
+      self.rate_limits.append((int(time.time()), key, retry_after, scope))
+    elif status == 0 or status >= 500:
+      route["errors"] += 1
+
+  def sample_heartbeat(self, latency: float) -> None:
+    if math.isfinite(latency): # inf until the first heartbeat is acknowledged
+      self.heartbeats.append(latency)
+
+  def top_routes(self, k: int=10, by: str="requests") -> list:
+    """
+    [(route, stats)] of the k routes with the most requests (or 429s, errors...)
+    """
+    return sorted(self.routes.items(), key=lambda item: item[1][by], reverse=True)[:k]
+
+  def summary(self) -> dict:
+    requests = sum(route["requests"] for route in self.routes.values())
+    heartbeats = list(self.heartbeats)
+    return {
+      "since": self.started,
+      "requests": requests,
+      "rate_limited": sum(route["rate_limited"] for route in self.routes.values()),
+      "errors": sum(route["errors"] for route in self.routes.values()),
+      "heartbeat_last": heartbeats[-1] if heartbeats else None,
+      "heartbeat_avg": sum(heartbeats) / len(heartbeats) if heartbeats else None,
+      "heartbeat_max": max(heartbeats) if heartbeats else None
+    }
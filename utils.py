@@ -6,7 +6,6 @@ import discord
 import asyncio
 import random
 import math
-import copy
 from vars import *
 
 def get_counter(t: int, cooldown: Optional[int]=0) -> str:
@@ -30,6 +29,21 @@ def get_counter(t: int, cooldown: Optional[int]=0) -> str:
   res += f"{sec}s"
   return res
 
+def bought_from_shop(record, others) -> list:
+  """
+  Items a user bought from today's shop, purchases made before the last shop reset don't count
+  """
+  bought = record["bought_from_shop"]
+  return bought["items"] if bought["reset"] == others["last_shop_reset"] else []
+
+def add_shop_purchase(record, others, item: str) -> None:
+  """
+  Records a shop purchase, stamped with the current shop reset
+  """
+  if record["bought_from_shop"]["reset"] != others["last_shop_reset"]:
+    record["bought_from_shop"] = {"reset": others["last_shop_reset"], "items": []}
+  record["bought_from_shop"]["items"].append(item)
+
 def fetch_stats_page(itx: discord.Interaction, user: int=None, page: Optional[Literal["Main Stats", "Command Stats", "Guild Stats", "Pet Stats"]]="Main Stats"): # game stats?
   """
   Returns user stats
@@ -46,16 +60,8 @@ def fetch_stats_page(itx: discord.Interaction, user: int=None, page: Optional[Li
   xp_bar = ""
   global_income_boost = list(itx.client.dbo["others"]["global_income_boost"].keys())
   global_income_boost = 0 if global_income_boost == [] else global_income_boost[0]
-  personal_inc = 0
-  personal_xp = 0
-  boosts = db["boosts"]
-  for type_ in boosts:
-    for boost in range(len(boosts[type_])): # boost = {mult: duration}
-      for k in boosts[type_][boost]:
-        if type_ == "income":
-          personal_inc += float(k)
-        else:
-          personal_xp += float(k)
+  personal_inc = db["boost_mult"]["income"]
+  personal_xp = db["boost_mult"]["xp"]
   
   levels = int(xp/xp_needed * 10)
   for i in range(0, levels):
@@ -249,6 +255,7 @@ class DailyButton(discord.ui.View):
     await itx.response.edit_message(view=self)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -286,6 +293,7 @@ class CraftRodButton(discord.ui.View):
     await itx.response.edit_message(view=self)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -314,6 +322,7 @@ class FishingWelcomeButton(discord.ui.View):
     await craft_rod_(itx, button)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -349,6 +358,7 @@ class FishButtons(discord.ui.View):
     await craft_rod_(itx, button)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -365,6 +375,7 @@ class SellIndiFish(discord.ui.Button):
     await view.sell_fish(view, itx, self.fish)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -431,6 +442,7 @@ class SellFish(discord.ui.View):
     
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -475,6 +487,7 @@ class QuestsButton(discord.ui.View):
     await itx.response.send_message(embed=embed, ephemeral=not claimed)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -509,6 +522,7 @@ class StatsButtons(discord.ui.View):
     await get_boosts(itx)
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     blacklist = itx.client.dbo["others"]["user_blacklist"]
     if str(itx.user.id) in blacklist:
       if int(time.time()) < blacklist[str(itx.user.id)]["time"]:
@@ -542,6 +556,7 @@ class UpgradesButton(discord.ui.View):
     self.stop()
 
   async def interaction_check(self, itx: discord.Interaction):
+    await itx.client.database.prefetch([itx.user.id])
     if self.userID == itx.user.id:
       return True
     return await itx.client.itx_check(itx)
@@ -701,9 +716,10 @@ async def get_upgrade(itx: discord.Interaction, type: str, name: str):
   while upgrade_again:
     upgrade_again = False
     upgrades = {}
-    upgrades.update(copy.deepcopy(itx.client.db["economy"][str(itx.user.id)]["upgrades"]["farm"]))
-    upgrades.update(copy.deepcopy(itx.client.db["economy"][str(itx.user.id)]["upgrades"]["factory"]))
-    upgrades.update(copy.deepcopy(itx.client.db["economy"][str(itx.user.id)]["upgrades"]["distribution_center"]))
+    for location in upgrade_catalog:
+      user_upgrades = itx.client.db["economy"][str(itx.user.id)]["upgrades"][location]
+      for upgrade, static in upgrade_catalog[location].items():
+        upgrades[upgrade] = {**static, "level": user_upgrades[upgrade]["level"]}
     # IGNORE COORDS (OLD FEATURE)
     #Farm
     upgrades["farmer"]["income"] = 25
@@ -975,14 +991,14 @@ async def get_boosts(itx: discord.Interaction):
   msg = ""
   boosts = itx.client.db["economy"][str(itx.user.id)]["boosts"].copy()
   boosts["global"] = [itx.client.dbo["others"]["global_income_boost"]]
-  # boosts = {"income": [{mult: duration}, {x: y}], "xp": [{x: y}]}
+  # boosts = {"income": [{mult: expiry tick}, {x: y}], "xp": [{x: y}]}
   for type_ in boosts:
-    msg += f"\n**{type_.title()}: ** \n" # boosts[type_] = [{mult: duration}, {x: y}]
+    msg += f"\n**{type_.title()}: ** \n" # boosts[type_] = [{mult: expiry tick}, {x: y}]
     if boosts[type_] in ([], [{}]):
       msg += f"You do not have any active boosts! \n"
     else:
-      for boost in boosts[type_]: # boosts[type_][boost] = {mult: duration}
-        msg += f"- **{list(boost.keys())[0]}x** boost ends in **{list(boost.values())[0]} hour(s)** \n"
+      for boost in boosts[type_]: # boosts[type_][boost] = {mult: expiry tick}
+        msg += f"- **{list(boost.keys())[0]}x** boost ends <t:{list(boost.values())[0]}:R> \n"
     
 
   embed = discord.Embed(
@@ -21,7 +21,45 @@ xp_needed_base = 10
 unix_day = 1661788800
 eco_prestige = [0, 1000000, 2500000, 5000000, 10000000, 20000000]
 lottery_channel = 924492712328171530
+db_flush_interval = 15 # seconds between write-behind flushes
+db_flush_threshold = 250 # flush straight away once this many records are waiting
+journal_sync_interval = 1 # seconds between journal fsyncs
+user_cache_size = 5000 # user records kept in memory
+backup_full_every = 7 # every nth backup is a full snapshot, the others only hold users changed since the previous one
+backup_keep_chains = 2 # full snapshots (and their deltas) kept on disk
+income_log_keep = 48 # hourly income logs kept in dump/income
+settlement_slice_budget = 0.025 # seconds a settlement sweep may hold the event loop for before yielding
+batch_workers = 2 # processes whole economy batch jobs are computed in (0 computes them on the event loop)
+batch_min_rows = 1000 # smaller batch jobs are computed on the event loop
+heartbeat_sample_interval = 30 # seconds between samples of the gateway latency
+leaderboards = {"balance": "balance", "bugs": "bugs_found", "sponsors": "sponsor", "levels": "levels.level", "tickets": "golden_ticket"} # leaderboard: field
+leaderboard_fields = ["balance", "levels.level", "golden_ticket", "sponsor"] # fields kept ranked in memory (see leaderboard.py)
+lottery_refresh = 30 # seconds a lottery embed update waits for, so a burst of entries is one edit
 restart_log_channel = 927434363317157899
+# Static upgrade data shared by every user, user records only store the level
+upgrade_catalog = {
+  "farm": {
+    "farmer": {"name": "Farmer", "max": 10},
+    "store": {"name": "Store", "max": 8},
+    "van": {"name": "Delivery Van", "max": 6},
+    "storage_tank": {"name": "Storage Tank", "max": 8},
+    "warehouse": {"name": "Warehouse", "max": 12},
+  },
+  "factory": {
+    "bean_grinder": {"name": "Bean Grinder", "max": 10},
+    "chocolate_moulder": {"name": "Chocolate Moulder", "max": 8},
+    "chocolate_freezer": {"name": "Chocolate Freezer", "max": 5},
+    "workers": {"name": "Worker", "max": 12},
+    "chocolate_packager": {"name": "Chocolate Packager", "max": 5},
+  },
+  "distribution_center": {
+    "fork_lifts": {"name": "Fork Lifts", "max": 15},
+    "packaging_machine": {"name": "Packaging Machine", "max": 15},
+    "storage_shelves": {"name": "Storage Shelves", "max": 12},
+    "trucks": {"name": "Trucks", "max": 8},
+    "managers": {"name": "Managers", "max": 10},
+  }
+}
 log_channel = 923029963580518431
 custom_emojis = {
   "726965815265722390" : "<:trolllol:944407059443617792>"